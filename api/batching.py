@@ -0,0 +1,111 @@
+import asyncio
+from typing import Callable, Optional
+
+import numpy as np
+
+
+class BatchScheduler:
+    """Coalesces the image batches of concurrent requests into one model call.
+
+    Requests queue their batch and wait on a future. A single task takes
+    the first queued batch, then keeps adding batches until `max_batch_size`
+    images are collected or `max_wait` seconds have passed, runs `predict`
+    on all of them in a thread and hands each request its own rows.
+    """
+    def __init__(self,
+                 predict: Callable[[np.ndarray], np.ndarray],
+                 max_batch_size: int = 32,
+                 max_wait: float = 0.005):
+        self.predict_fn = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.num_batches = 0
+        self.num_images = 0
+        self.last_batch_size = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        'Start the batching task on the running event loop'
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def predict(self, batch: np.ndarray) -> np.ndarray:
+        'Predict a batch of preprocessed images, sharing a model call with other requests'
+        self.start()
+        # Split large requests so no model call exceeds the maximum batch size
+        futures = []
+        for start in range(0, len(batch), self.max_batch_size):
+            future = asyncio.get_running_loop().create_future()
+            await self._queue.put((batch[start:start + self.max_batch_size], future))
+            futures.append(future)
+        return np.concatenate(await asyncio.gather(*futures))
+
+    def stats(self) -> dict[str, float]:
+        return {
+            'queue_depth': 0 if self._queue is None else self._queue.qsize(),
+            'batches': self.num_batches,
+            'images': self.num_images,
+            'last_batch_size': self.last_batch_size,
+            'mean_batch_size': self.num_images / self.num_batches if self.num_batches else 0,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self._queue.get()]
+            size = len(requests[0][0])
+            deadline = loop.time() + self.max_wait
+            while True:
+                # Take anything already queued without waiting, so a backlog is drained
+                # in full batches, then wait out the rest of the window for more
+                timeout = deadline - loop.time()
+                if not self._queue.empty():
+                    request = self._queue.get_nowait()
+                elif timeout > 0:
+                    try:
+                        request = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    break
+                if size + len(request[0]) > self.max_batch_size:
+                    # Leave it for the next batch
+                    await self._run_batch(requests)
+                    requests, size = [], 0
+                    deadline = loop.time() + self.max_wait
+                requests.append(request)
+                size += len(request[0])
+            await self._run_batch(requests)
+
+    async def _run_batch(self, requests: list[tuple[np.ndarray, asyncio.Future]]):
+        if len(requests) == 0:
+            return
+        batch = np.concatenate([batch for batch, _ in requests])
+        try:
+            # Run the model in a thread so the event loop keeps serving requests
+            predictions = await asyncio.get_running_loop().run_in_executor(None, self.predict_fn, batch)
+        except Exception as err:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        self.num_batches += 1
+        self.num_images += len(batch)
+        self.last_batch_size = len(batch)
+        start = 0
+        for request_batch, future in requests:
+            if not future.done():
+                future.set_result(predictions[start:start + len(request_batch)])
+            start += len(request_batch)
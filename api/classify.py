@@ -1,56 +1,160 @@
 import json
+from threading import Lock
+
+import cv2
 import numpy as np
 import os
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
-import tensorflow as tf
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+from .metrics import timed
+
+# Model input height and width
+IMG_SIZE = (160, 160)
+# Batch sizes the model is traced for, smaller batches are padded up to the next size
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+MODEL_PATHS = {
+    'keras': 'api/scene-classifier',
+    # Written by quantize.py
+    'tflite': 'api/scene-classifier.tflite',
+}
+
+
+class KerasBackend:
+    'Runs the SavedModel with TensorFlow'
+    def __init__(self, model_path: str):
+        import tensorflow as tf
+        self.tf = tf
+        self.model = tf.keras.models.load_model(model_path)
+        # Calling the model as a traced graph skips the data pipeline `model.predict` sets up per call
+        self._infer = tf.function(lambda batch: self.model(batch, training=False))
+        self._bucket_fns = dict()
+        self._bucket_fns_lock = Lock()
+
+    def predict_bucket(self, batch: np.ndarray) -> np.ndarray:
+        return self._bucket_fn(len(batch))(self.tf.constant(batch)).numpy()
+
+    def _bucket_fn(self, bucket: int):
+        'Model traced with a fixed input signature for a batch size, traced on first use'
+        with self._bucket_fns_lock:
+            if bucket not in self._bucket_fns:
+                self._bucket_fns[bucket] = self._infer.get_concrete_function(
+                    self.tf.TensorSpec((bucket, *IMG_SIZE, 3), dtype=self.tf.float32))
+            return self._bucket_fns[bucket]
+
+
+class TFLiteBackend:
+    '''Runs a quantized model with the TFLite interpreter, from the lightweight
+    `tflite_runtime` package if installed so that TensorFlow is never imported'''
+    def __init__(self, model_path: str, num_threads: int = None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self._input = self.interpreter.get_input_details()[0]['index']
+        self._output = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        # The interpreter's tensors are shared state
+        self._lock = Lock()
+
+    def predict_bucket(self, batch: np.ndarray) -> np.ndarray:
+        with self._lock:
+            if self._batch_size != len(batch):
+                self.interpreter.resize_tensor_input(self._input, batch.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_size = len(batch)
+            self.interpreter.set_tensor(self._input, batch)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output).copy()
+
 
 class ImageSceneClassifier:
     def __init__(self,
-                 model_path='api/scene-classifier',
-                 categories_path='dataset/categories.json'):
-        self.model = tf.keras.models.load_model(model_path)
+                 model_path=None,
+                 categories_path='dataset/categories.json',
+                 backend='keras'):
+        '''`backend` is `keras` to run the SavedModel with TensorFlow, 
+        or `tflite` to run the quantized model written by quantize.py.
+        Any other object with a `predict_bucket` method, such as a stub
+        model for benchmarks, is used as the backend as it is.'''
+        if not isinstance(backend, str):
+            self.version = type(backend).__name__
+            self.backend = backend
+        else:
+            model_path = model_path or MODEL_PATHS[backend]
+            # Identifies this model's results in the result cache, and changes when the model is replaced
+            self.version = f'{backend}-{int(os.path.getmtime(model_path))}'
+            if backend == 'tflite':
+                self.backend = TFLiteBackend(model_path, num_threads=os.cpu_count())
+            else:
+                self.backend = KerasBackend(model_path)
         with open(categories_path, 'r') as f:
             categories = json.loads(f.read())
             self.categories = list(map(str.capitalize, categories))
-    
+
     def predict(self, images: list[np.ndarray]):
-        img_batch = self._process_batch(images)
-        # Convert numpy array batch to tensor to feed to model
-        input_batch = tf.convert_to_tensor(img_batch, dtype=tf.float32)
-        return self.model.predict(input_batch, verbose=False)
-    
-    def _process_img(self, img):
-        # Smart resize crops and resizes as to maintain the original image's aspect ratio
-        resized_img = tf.keras.preprocessing.image.smart_resize(img, ((160, 160)))
-        return tf.keras.utils.img_to_array(resized_img)
-    
-    def _process_batch(self, img_batch):
-        return np.array(list(map(self._process_img, img_batch)))
-    
+        return self.predict_batch(self.process_batch(images))
+
+    @timed('classify_inference')
+    def predict_batch(self, img_batch: np.ndarray):
+        'Predict a batch of images already resized by `process_batch`'
+        predictions = []
+        for start in range(0, len(img_batch), BATCH_BUCKETS[-1]):
+            chunk = img_batch[start:start + BATCH_BUCKETS[-1]]
+            bucket = next(size for size in BATCH_BUCKETS if size >= len(chunk))
+            if bucket > len(chunk):
+                chunk = np.pad(chunk, ((0, bucket - len(chunk)), (0, 0), (0, 0), (0, 0)))
+            output = self.backend.predict_bucket(chunk)
+            predictions.append(output[:len(img_batch) - start])
+        return np.concatenate(predictions)
+
+    @staticmethod
+    def _process_img(img, out):
+        # Crop the centre to the model's aspect ratio and resize, as smart resize does,
+        # to maintain the original image's aspect ratio
+        height, width = img.shape[:2]
+        crop_height = min(height, int(width * IMG_SIZE[0] / IMG_SIZE[1]))
+        crop_width = min(width, int(height * IMG_SIZE[1] / IMG_SIZE[0]))
+        top = (height - crop_height) // 2
+        left = (width - crop_width) // 2
+        crop = img[top:top + crop_height, left:left + crop_width]
+        # Bilinear without antialiasing, like tf.image.resize, written straight into the batch
+        out[:] = cv2.resize(crop, IMG_SIZE[::-1], interpolation=cv2.INTER_LINEAR)
+
+    @staticmethod
+    @timed('classify_preprocessing')
+    def process_batch(img_batch) -> np.ndarray:
+        'Resize every image into one preallocated float32 batch'
+        batch = np.empty((len(img_batch), *IMG_SIZE, 3), dtype=np.float32)
+        for img, out in zip(img_batch, batch):
+            ImageSceneClassifier._process_img(img, out)
+        return batch
+
+    @timed('classify_tags')
     def tags_from_predictions(self, predictions):
+        predictions = np.asarray(predictions)
+        # Choose the indices of the top 2 predictions of every row,
+        # then order each pair by probability
+        top2_pred_indices = np.argpartition(predictions, -2, axis=1)[:, -2:]
+        top2_probs = np.take_along_axis(predictions, top2_pred_indices, axis=1)
+        order = np.argsort(-top2_probs, axis=1)
+        top2_pred_indices = np.take_along_axis(top2_pred_indices, order, axis=1)
+        top2_probs = np.take_along_axis(top2_probs, order, axis=1)
+
+        # Formula for picking a "good" set of image tags
+        # If top tag has 90% probability, select it only
+        top1_only = top2_probs[:, 0] > 0.9
+        # When top 2 sum to at least 50%, choose both
+        top2_both = ~top1_only & (top2_probs.sum(axis=1) > 0.5)
+
         image_tags = []
-        for prediction in predictions:
-            # Choose the indices of the top 3 predictions
-            top2_pred_indices = np.argsort(prediction)[::-1][:2]
-            
-            # Create a mapping from category to prediction probability for each top 3 result
-            top2_pred = { self.categories[idx]: prediction[idx] for idx in top2_pred_indices }
-            
-            # Collection of (category, probability) pairs
-            top2_pairs = list(top2_pred.items())
-            
-            # Formula for picking a "good" set of image tags    
-            tags = []
-            
-            # If top tag has 90% probability, select it only
-            if top2_pairs[0][1] > 0.9:
-                tags.append(top2_pairs[0][0])
-            # When top 2 sum to at least 50%, choose both
-            elif top2_pairs[0][1] + top2_pairs[1][1] > 0.5:
-                tags.append(top2_pairs[0][0])
-                tags.append(top2_pairs[1][0])
+        for (first, second), one, both in zip(top2_pred_indices, top1_only, top2_both):
+            if one:
+                image_tags.append([self.categories[first]])
+            elif both:
+                image_tags.append([self.categories[first], self.categories[second]])
             else:
-                tags.append("Unknown")
-            
-            image_tags.append(tags)
-        return image_tags
\ No newline at end of file
+                image_tags.append(["Unknown"])
+        return image_tags
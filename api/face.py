@@ -1,36 +1,222 @@
-from collections import defaultdict
+import multiprocessing
+import os
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from random import choice
-from typing import Union
+from threading import Lock
+from time import perf_counter
+from typing import TYPE_CHECKING, Optional, Union
 
 import numpy as np
-from sklearn.cluster import AgglomerativeClustering
-from face_recognition import (compare_faces,
-                              face_encodings, face_landmarks)
+from fastapi import HTTPException
+from PIL import Image as PILImage
+# face_recognition and sklearn are imported where they are used, since
+# importing them (and loading dlib's models) slows server startup
 
-from .util.image import base64_img_to_array
-from .util.models import FaceEncoding, Image, Person, PersonFaces
+from .util.image import (FACE_DETECT_IMAGE_SIZE, FACE_ENCODE_IMAGE_SIZE,
+                         bytes_img_to_array, downscale, image_digest)
+from .metrics import IMAGES_WITHOUT_FACES, STAGE_SECONDS, timed
+from .result_cache import ResultCache
+from .util.models import ENCODING_DTYPE, FaceEncoding, ImageFile, Person, PersonFaces
+if TYPE_CHECKING:
+    from .face_index import FaceIndex
 
+# Distance under which two encodings are considered the same face,
+# the default tolerance of `face_recognition.compare_faces`
+TOLERANCE = 0.6
+ENCODING_SIZE = 128
+# Maximum number of entries in one intermediate distance matrix
+MAX_DISTANCE_ELEMENTS = 4_000_000
+# Number of processes encoding faces in parallel, 0 or 1 encodes them in the calling process
+FACE_WORKERS = min(int(os.environ.get('FACE_WORKERS', 4)), os.cpu_count() or 1)
 
-def get_face_encodings(images: list[Image]) -> list[FaceEncoding]:
-    """Converts a base-64 image into np array and
+# Identifies the face encodings of an image in the result cache,
+# with faces detected and encoded at the same size
+FACE_ENCODER_VERSION = f'dlib-small-hog-{FACE_ENCODE_IMAGE_SIZE}'
+# Distance under which hierarchical clustering merges faces into one new person
+CLUSTER_THRESHOLD = 0.6
+# Largest number of faces clustered at once, above which faces are first grouped
+CLUSTER_EXACT_MAX_FACES = 2000
+# Number of images whose face locations are remembered
+FACE_LOCATIONS_CACHE_SIZE = 10_000
+
+# A face's (top, right, bottom, left) box in pixels
+FaceLocation = tuple[int, int, int, int]
+# A face's box as fractions of the image's height and width, 
+# so it can be mapped onto the image decoded at any size
+RelativeFaceLocation = tuple[float, float, float, float]
+
+_face_pool: Optional[ProcessPoolExecutor] = None
+# The size each image's faces were detected at, and their locations
+_face_locations: OrderedDict[str, tuple[int, list[RelativeFaceLocation]]] = OrderedDict()
+_face_locations_lock = Lock()
+
+
+def detect_faces(img: np.ndarray, size: int = FACE_DETECT_IMAGE_SIZE) -> list[FaceLocation]:
+    """Find the location of every face in an image, without computing
+    landmarks. Detection runs on a copy no larger than `size` and the
+    boxes are mapped back onto the full image. Faces smaller than about
+    40 pixels on the copy are not found."""
+    from face_recognition import face_locations
+    height, width = img.shape[:2]
+    small_img = img
+    if min(height, width) > size:
+        small_img = np.asarray(downscale(PILImage.fromarray(img), size))
+    locations = face_locations(small_img, number_of_times_to_upsample=1, model="hog")
+    return to_absolute_locations(
+        to_relative_locations(locations, small_img.shape), img.shape)
+
+
+def to_relative_locations(locations: list[FaceLocation], shape: tuple) -> list[RelativeFaceLocation]:
+    height, width = shape[:2]
+    return [(top / height, right / width, bottom / height, left / width)
+            for top, right, bottom, left in locations]
+
+
+def to_absolute_locations(locations: list[RelativeFaceLocation], shape: tuple) -> list[FaceLocation]:
+    height, width = shape[:2]
+    return [(round(top * height), min(round(right * width), width),
+             min(round(bottom * height), height), round(left * width))
+            for top, right, bottom, left in locations]
+
+
+def cache_face_locations(digest: str, locations: list[RelativeFaceLocation], size: int):
+    with _face_locations_lock:
+        _face_locations[digest] = (size, locations)
+        _face_locations.move_to_end(digest)
+        if len(_face_locations) > FACE_LOCATIONS_CACHE_SIZE:
+            _face_locations.popitem(last=False)
+
+
+def cached_face_locations(digest: str, min_size: int) -> Optional[list[RelativeFaceLocation]]:
+    'Face locations of an image if they were detected at `min_size` or larger'
+    with _face_locations_lock:
+        size, locations = _face_locations.get(digest, (0, None))
+    return locations if size >= min_size else None
+
+
+def _get_face_pool() -> ProcessPoolExecutor:
+    global _face_pool
+    if _face_pool is None:
+        # Spawn rather than fork the server process, which may be running threads.
+        # Each worker imports face_recognition once, loading dlib's models for its lifetime
+        _face_pool = ProcessPoolExecutor(
+            max_workers=FACE_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'))
+    return _face_pool
+
+
+def _warm_worker(_):
+    'Load dlib\'s models in a worker and run them once'
+    detect_faces(np.zeros((64, 64, 3), dtype=np.uint8))
+
+
+def warm_face_pool():
+    'Start the face encoding workers ahead of the first request'
+    if FACE_WORKERS > 1:
+        list(_get_face_pool().map(_warm_worker, range(FACE_WORKERS)))
+    else:
+        _warm_worker(None)
+
+
+def shutdown_face_pool():
+    global _face_pool
+    if _face_pool is not None:
+        _face_pool.shutdown()
+        _face_pool = None
+
+
+def _encode_image(
+    img_bytes: bytes,
+    locations: Optional[list[RelativeFaceLocation]]
+) -> tuple[list[np.ndarray], list[RelativeFaceLocation], Optional[tuple[int, str]], dict[str, float]]:
+    """Decode an image file and find the encoding of every face in it.
+    Run in worker processes, so only the compressed image is sent to them
+    and only the 128-d encodings are sent back.
+
+    Faces are only detected if their `locations` are not already known.
+
+    Returns:
+        Face encodings, the locations of the faces, the status code and detail 
+        of the `HTTPException` raised for an invalid image, since it cannot be pickled,
+        and the time taken by each stage, to be recorded by the calling process.
+    """
+    from face_recognition import face_encodings
+    timings = dict()
+    start = perf_counter()
+    try:
+        img_arr = bytes_img_to_array(img_bytes, FACE_ENCODE_IMAGE_SIZE)
+    except HTTPException as err:
+        return [], [], (err.status_code, err.detail), timings
+    timings['image_decode'] = perf_counter() - start
+    if locations is None:
+        start = perf_counter()
+        # Detect at the full encoding size, as faces in group photos can be small
+        known_locations = detect_faces(img_arr, FACE_ENCODE_IMAGE_SIZE)
+        locations = to_relative_locations(known_locations, img_arr.shape)
+        timings['face_detection'] = perf_counter() - start
+    else:
+        known_locations = to_absolute_locations(locations, img_arr.shape)
+    start = perf_counter()
+    encodings = face_encodings(img_arr, known_face_locations=known_locations, model="small")
+    timings['face_encoding'] = perf_counter() - start
+    return encodings, locations, None, timings
+
+
+def get_face_encodings(images: list[ImageFile],
+                       workers: int = FACE_WORKERS,
+                       cache: Optional[ResultCache] = None) -> list[FaceEncoding]:
+    """Converts an image file into np array and
     finds the face encoding output for every face
     in the image.
 
+    Images are spread across a pool of worker processes
+    when there is more than one image and worker.
+
     Args:
-        images (list[Image]): List of images
+        images (list[ImageFile]): List of images
+        workers (int): Use worker processes if greater than 1, otherwise encode serially
+        cache (ResultCache): Reuse the encodings of images which have been encoded before
 
     Returns:
-        list[FaceEncoding]: List of face encodings for each face in every image. \n
+        list[FaceEncoding]: List of face encodings for each face in every image, in image order. \n
         All images are assumed to have a face. If not, procedure still exits peacefully.
     """
-    face_encodings_list = []
-    for img in images:
-        img_arr = base64_img_to_array(img.data)
+    digests = [image_digest(img.data) for img in images]
+    results = [None] * len(images)
+    if cache is not None:
+        for i, digest in enumerate(digests):
+            cached = cache.get('faces', digest, FACE_ENCODER_VERSION)
+            if cached is not None:
+                encodings = [np.frombuffer(enc, dtype=ENCODING_DTYPE) for enc in cached['encodings']]
+                results[i] = (encodings, None, None)
+    to_encode = [i for i, result in enumerate(results) if result is None]
 
-        # Find face encodings for each face in the image
-        encodings = face_encodings(img_arr, model="small")
+    img_bytes = [images[i].data for i in to_encode]
+    # Reuse face locations found when the image was encoded before, but not those found
+    # when it was classified, which were detected too small to find every face
+    locations = [cached_face_locations(digests[i], FACE_ENCODE_IMAGE_SIZE) for i in to_encode]
+    if workers > 1 and len(to_encode) > 1:
+        # map returns results in input order
+        encoded = _get_face_pool().map(_encode_image, img_bytes, locations)
+    else:
+        encoded = map(_encode_image, img_bytes, locations)
+    for i, (encodings, img_locations, error, timings) in zip(to_encode, encoded):
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        if error is not None:
+            raise HTTPException(status_code=error[0], detail=error[1])
+        cache_face_locations(digests[i], img_locations, FACE_ENCODE_IMAGE_SIZE)
+        if cache is not None:
+            cache.put('faces', digests[i], FACE_ENCODER_VERSION, {'encodings': [
+                np.asarray(enc, dtype=ENCODING_DTYPE).tobytes() for enc in encodings]})
+        results[i] = (encodings, img_locations, None)
+
+    face_encodings_list = []
+    for img, (encodings, _, _) in zip(images, results):
         if len(encodings) == 0:
-            print(img.id)
+            IMAGES_WITHOUT_FACES.inc()
 
         faces = [FaceEncoding(image_id=img.id, encoding=enc)
                  for enc in encodings]
@@ -39,9 +225,78 @@ def get_face_encodings(images: list[Image]) -> list[FaceEncoding]:
     return face_encodings_list
 
 
+def face_distances(known: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    """Euclidean distance between every face in `faces` and every
+    encoding in `known`, computed in a single matrix product.
+
+    Args:
+        known (np.ndarray): (n_known, 128) matrix of stored encodings
+        faces (np.ndarray): (n_faces, 128) matrix of new encodings
+
+    Returns:
+        np.ndarray: (n_faces, n_known) distance matrix
+    """
+    # |a - b|^2 = |a|^2 + |b|^2 - 2a.b
+    sq_dists = faces @ known.T
+    sq_dists *= -2
+    sq_dists += np.einsum('ij,ij->i', faces, faces)[:, None]
+    sq_dists += np.einsum('ij,ij->i', known, known)[None, :]
+    # Rounding can leave tiny negatives for identical encodings
+    np.maximum(sq_dists, 0, out=sq_dists)
+    return np.sqrt(sq_dists, out=sq_dists)
+
+
+@dataclass
+class FaceMatrix:
+    """All of a user's stored face encodings stacked into one matrix.
+    Rows belonging to the same person are contiguous; `offsets[j]` is the
+    first row of `people[j]`, so per-person reductions can use `reduceat`.
+    """
+    people: list[Person]
+    encodings: np.ndarray
+    offsets: np.ndarray
+
+    @staticmethod
+    def from_people(people: dict[Person, list[FaceEncoding]]) -> 'FaceMatrix':
+        # People without encodings can never match, and would break reduceat
+        people = {person: faces for person, faces in people.items() if len(faces) > 0}
+        counts = [len(faces) for faces in people.values()]
+        if len(counts) == 0:
+            return FaceMatrix([], np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE),
+                              np.empty(0, dtype=np.intp))
+
+        encodings = np.array([face.encoding for faces in people.values() for face in faces],
+                             dtype=ENCODING_DTYPE)
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+        return FaceMatrix(list(people.keys()), encodings, offsets)
+
+    def __len__(self):
+        return len(self.encodings)
+
+    def min_person_distances(self, faces: np.ndarray) -> np.ndarray:
+        """Distance from each face to the closest encoding of each person.
+
+        Returns:
+            np.ndarray: (n_faces, n_people) distance matrix
+        """
+        min_dists = np.empty((len(faces), len(self.people)), dtype=self.encodings.dtype)
+        # Bound the size of the intermediate (faces x encodings) matrix
+        chunk = max(1, MAX_DISTANCE_ELEMENTS // max(1, len(self)))
+        for start in range(0, len(faces), chunk):
+            dists = face_distances(self.encodings, faces[start:start + chunk])
+            min_dists[start:start + chunk] = np.minimum.reduceat(dists, self.offsets, axis=1)
+        return min_dists
+
+    def matches(self, faces: np.ndarray, tolerance: float = TOLERANCE) -> np.ndarray:
+        'Whether each face is within tolerance of any encoding of each person'
+        return self.min_person_distances(faces) <= tolerance
+
+
+@timed('face_matching')
 def match_face_encodings_to_people(
     face_encodings: list[FaceEncoding],
-    people: dict[Person, list[FaceEncoding]]
+    people: Union[dict[Person, list[FaceEncoding]], FaceMatrix, 'FaceIndex'],
+    tolerance: float = TOLERANCE
 ) -> tuple[list[FaceEncoding], dict[Person, list[FaceEncoding]]]:
     """
     Matches a list of encodings of faces from an image 
@@ -50,6 +305,11 @@ def match_face_encodings_to_people(
     encoding in `encodings`. If below a threshold,
     the encoding is added to the person's face list.
 
+    All distances are computed in one pass over a `FaceMatrix` of the
+    user's encodings, then reduced to the closest encoding per person.
+    A `FaceIndex` instead only compares faces with the partitions of
+    encodings which could be within tolerance of them.
+
     Some encodings may be unmatched, and are collected as the
     first element in the returned tuple. These are later used
     to create a new person/several new people.
@@ -60,37 +320,38 @@ def match_face_encodings_to_people(
     Args:
         face_encodings (list[FaceEncoding]): 
             List of face encodings to be matched.
-        people: (dict[str, list[FaceEncoding]]): 
-            Mapping from person id to list of face encodings which are similar to each other.
+        people: (dict[str, list[FaceEncoding]] | FaceMatrix | FaceIndex): 
+            Mapping from person id to list of face encodings which are similar to each other,
+            or the same encodings already stacked into a `FaceMatrix` or indexed by a `FaceIndex`.
+        tolerance (float):
+            Maximum distance between two encodings of the same face, as in `face_recognition.compare_faces`.
 
     Returns:
         `tuple[list[FaceEncoding], dict[str, list[FaceEncoding]]]`: 
             Tuple of unmatched encodings and a new mapping from existing person id to new face encodings.
     """
-    # Initially all encodings are unmatched
-    matched_faces = [False for _ in range(len(face_encodings))]
+    if isinstance(people, dict):
+        people = FaceMatrix.from_people(people)
+    if len(face_encodings) == 0 or len(people) == 0:
+        return list(face_encodings), defaultdict(list)
+
+    faces = np.array([face.encoding for face in face_encodings], dtype=ENCODING_DTYPE)
+    # A face matches a person if it is within tolerance of any of their encodings
+    matches = people.matches(faces, tolerance)
+
     new_people_faces = defaultdict(list)
-    for person, person_faces in people.items():
-        # Since `encodings` comes from one image (with at least one detected face),
-        # if any encoding from `encodings` matches any encoding
-        # person_encoding in `person_encs`, add the `encodings` to the
-        # list under `person_id` dict key
-        for i, face in enumerate(face_encodings):
-            person_encodings = [face.encoding for face in person_faces]
-            # If enc matches any face encodings for the person, add to new_people_faces dict
-            if any(compare_faces(person_encodings, face.encoding)):
-                new_people_faces[person].append(face)
-            else:
-                # Mark encoding as being matched to a person
-                matched_faces[i] = True
+    # Row-major order keeps each person's new faces in input order
+    for face_idx, person_idx in zip(*np.nonzero(matches)):
+        new_people_faces[people.people[person_idx]].append(face_encodings[face_idx])
 
     # These encodings will create a new person/several new people
-    unmatched_faces = [face_encodings[i] for (
-        i, is_matched) in enumerate(matched_faces) if not is_matched]
+    is_matched = matches.any(axis=1)
+    unmatched_faces = [face for face, matched in zip(face_encodings, is_matched) if not matched]
 
     return unmatched_faces, new_people_faces
 
 
+@timed('face_clustering')
 def cluster_unmatched_encodings(
     faces: list[FaceEncoding],
     num_existing_people: int
@@ -99,21 +360,23 @@ def cluster_unmatched_encodings(
     Group them using hierarchical clustering with Euclidean distance
     as a metric and a distance threshold of 0.6.
 
+    Hierarchical clustering needs memory quadratic in the number of faces,
+    so above `CLUSTER_EXACT_MAX_FACES` faces are first split into groups
+    with `leader_groups` and each group is clustered on its own.
+
     Args:
         num_existing_people: 
             int number of people already in database, used to assign numbers to new people
     """
     if len(faces) == 0:
         return dict()
-    samples = np.array([face.encoding for face in faces])
-    clustering = AgglomerativeClustering(
-        n_clusters=None,
-        affinity="euclidean",
-        distance_threshold=0.6
-    ).fit(samples)
+    samples = np.array([face.encoding for face in faces], dtype=ENCODING_DTYPE)
+    if len(samples) <= CLUSTER_EXACT_MAX_FACES:
+        people = agglomerative_labels(samples)
+    else:
+        people = grouped_cluster_labels(samples)
 
     # Grouped images represent a single person
-    people = clustering.labels_
     people_faces = defaultdict(list)
     for i, person_num in enumerate(people):
         name = f'Person {person_num + num_existing_people + 1}'
@@ -121,32 +384,164 @@ def cluster_unmatched_encodings(
     return people_faces
 
 
-def has_face(imgs: list[np.ndarray]):
-    return [i for i, face_boxes in enumerate([face_landmarks(img) for img in imgs]) if face_boxes is not []]
+def agglomerative_labels(samples: np.ndarray, threshold: float = CLUSTER_THRESHOLD) -> np.ndarray:
+    'Cluster label of each encoding, from clustering all of them at once'
+    if len(samples) == 1:
+        return np.zeros(1, dtype=np.intp)
+    from sklearn.cluster import AgglomerativeClustering
+    clustering = AgglomerativeClustering(
+        n_clusters=None,
+        distance_threshold=threshold
+    ).fit(samples)
+    return clustering.labels_
+
+
+def leader_groups(samples: np.ndarray, radius: float = CLUSTER_THRESHOLD) -> np.ndarray:
+    """Split encodings into groups of similar faces in a single pass.
+    Each encoding joins the group of the closest leader within `radius`,
+    or else leads a new group, so leaders are at least `radius` apart.
+
+    Returns:
+        np.ndarray: group number of each encoding
+    """
+    groups = np.empty(len(samples), dtype=np.intp)
+    leaders = np.empty((0, samples.shape[1]), dtype=samples.dtype)
+    block_size = 1024
+    for start in range(0, len(samples), block_size):
+        block = samples[start:start + block_size]
+        near = np.zeros(len(block), dtype=bool)
+        if len(leaders) > 0:
+            chunk = max(1, MAX_DISTANCE_ELEMENTS // len(leaders))
+            for offset in range(0, len(block), chunk):
+                dists = face_distances(leaders, block[offset:offset + chunk])
+                closest = dists.argmin(axis=1)
+                near[offset:offset + chunk] = dists[np.arange(len(dists)), closest] <= radius
+                groups[start + offset:start + offset + len(dists)] = closest
+
+        # The rest of the block can only join leaders found within the block
+        new_leaders = []
+        for i in np.flatnonzero(~near):
+            if len(new_leaders) > 0:
+                dists = np.linalg.norm(np.array(new_leaders) - block[i], axis=1)
+                closest = dists.argmin()
+                if dists[closest] <= radius:
+                    groups[start + i] = len(leaders) + closest
+                    continue
+            groups[start + i] = len(leaders) + len(new_leaders)
+            new_leaders.append(block[i])
+        if len(new_leaders) > 0:
+            leaders = np.concatenate([leaders, np.array(new_leaders, dtype=samples.dtype)])
+    return groups
+
+
+def grouped_cluster_labels(samples: np.ndarray, threshold: float = CLUSTER_THRESHOLD) -> np.ndarray:
+    """Cluster label of each encoding, clustering each `leader_groups` group
+    on its own. A group larger than `CLUSTER_EXACT_MAX_FACES` is clustered
+    from a sample, and the rest of its encodings take the label of their
+    closest sampled encoding. Clusters from neighbouring groups are then
+    merged when the Ward distance between them is within `threshold`,
+    as hierarchical clustering over all encodings would have merged them.
+    """
+    groups = leader_groups(samples, threshold)
+    labels = np.empty(len(samples), dtype=np.intp)
+    rng = np.random.default_rng(0)
+    num_clusters = 0
+    for members in np.split(np.argsort(groups, kind='stable'),
+                            np.flatnonzero(np.diff(np.sort(groups))) + 1):
+        if len(members) <= CLUSTER_EXACT_MAX_FACES:
+            group_labels = agglomerative_labels(samples[members], threshold)
+        else:
+            sampled = np.sort(rng.choice(len(members), CLUSTER_EXACT_MAX_FACES, replace=False))
+            sample_labels = agglomerative_labels(samples[members[sampled]], threshold)
+            group_labels = np.empty(len(members), dtype=np.intp)
+            chunk = max(1, MAX_DISTANCE_ELEMENTS // len(sampled))
+            for start in range(0, len(members), chunk):
+                dists = face_distances(samples[members[sampled]], samples[members[start:start + chunk]])
+                group_labels[start:start + chunk] = sample_labels[dists.argmin(axis=1)]
+        labels[members] = group_labels + num_clusters
+        num_clusters += group_labels.max() + 1
+
+    # Clusters split across groups are merged as clustering all faces would have
+    labels = merge_close_clusters(samples, labels, threshold)
+    # Number the clusters from 0 in order of first appearance
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    return np.argsort(np.argsort(first))[inverse]
+
+
+def merge_close_clusters(samples: np.ndarray, labels: np.ndarray, threshold: float = CLUSTER_THRESHOLD) -> np.ndarray:
+    """Repeatedly merge every pair of clusters which are each other's closest
+    cluster by Ward distance, the distance hierarchical clustering merges by,
+    while that distance is within `threshold`.
+
+    Returns:
+        np.ndarray: cluster label of each encoding, a subset of `labels`
+    """
+    sizes = np.bincount(labels).astype(np.float64)
+    centroids = np.zeros((len(sizes), samples.shape[1]))
+    np.add.at(centroids, labels, samples)
+    centroids /= np.maximum(sizes, 1)[:, None]
+    merged_into = np.arange(len(sizes))
+    active = np.flatnonzero(sizes)
+    while len(active) > 1:
+        nearest = np.empty(len(active), dtype=np.intp)
+        nearest_dists = np.empty(len(active))
+        chunk = max(1, MAX_DISTANCE_ELEMENTS // len(active))
+        for start in range(0, len(active), chunk):
+            dists = face_distances(centroids[active], centroids[active[start:start + chunk]])
+            rows = np.arange(len(dists))
+            size_a, size_b = sizes[active[start:start + chunk], None], sizes[None, active]
+            dists *= np.sqrt(2 * size_a * size_b / (size_a + size_b))
+            dists[rows, start + rows] = np.inf
+            nearest[start:start + len(dists)] = dists.argmin(axis=1)
+            nearest_dists[start:start + len(dists)] = dists[rows, nearest[start:start + len(dists)]]
+
+        indices = np.arange(len(active))
+        pairs = np.flatnonzero((nearest[nearest] == indices) & (indices < nearest)
+                               & (nearest_dists <= threshold))
+        if len(pairs) == 0:
+            break
+        a, b = active[pairs], active[nearest[pairs]]
+        centroids[a] = (centroids[a] * sizes[a, None] + centroids[b] * sizes[b, None]) \
+            / (sizes[a] + sizes[b])[:, None]
+        sizes[a] += sizes[b]
+        merged_into[b] = a
+        active = np.setdiff1d(active, b)
+
+    # Follow chains of merges to the cluster they ended in
+    while np.any(merged_into[merged_into] != merged_into):
+        merged_into = merged_into[merged_into]
+    return merged_into[labels]
+
+
+@timed('face_detection')
+def has_face(imgs: list[np.ndarray], digests: list[str]) -> list[bool]:
+    """Whether each image has a face, reusing the face locations found
+    when the image was classified or encoded before."""
+    face_flags = []
+    for img, digest in zip(imgs, digests):
+        locations = cached_face_locations(digest, FACE_DETECT_IMAGE_SIZE)
+        if locations is None:
+            locations = to_relative_locations(detect_faces(img), img.shape)
+            cache_face_locations(digest, locations, FACE_DETECT_IMAGE_SIZE)
+        face_flags.append(len(locations) > 0)
+    return face_flags
 
 
-def to_person_img_ids(people: dict[Person, list[FaceEncoding]]) -> list[PersonFaces]:
-    """Convert a dict from person id to face list into a list of dicts
+def to_person_img_ids(people: dict[Person, list[str]]) -> list[PersonFaces]:
+    """Convert a dict from person id to image id list into a list of dicts
     with `name` and `image_ids` attributes."""
     return [
         PersonFaces(
             name=person.name,
             id=str(person.id), 
-            image_ids=[enc.image_id for enc in encodings]
+            image_ids=image_ids
         )
-        for person, encodings in people.items()
+        for person, image_ids in people.items()
     ]
-    # [
-    #     {
-    #         'name': person.name,
-    #         'id': str(person.id),
-    #         'image_ids': [enc.image_id for enc in encodings]
-    #     }
-    #     for person, encodings in people.items()
-    # ]
 
 
 if __name__ == "__main__":
+    from face_recognition import face_encodings
     enc1 = face_encodings("util/elon-large.jpg")[0]
     enc2 = face_encodings("util/elon-small.jpg")[0]
     faces = [
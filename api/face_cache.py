@@ -0,0 +1,204 @@
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+from os import environ
+from typing import Optional, Union
+
+from bson import ObjectId
+
+from .face import ENCODING_SIZE, FaceMatrix
+from .face_index import INDEX_MIN_ENCODINGS, FaceIndex
+from .metrics import CACHE_LOOKUPS
+from .util.models import FaceEncoding, Person
+
+# Rough in-memory cost of one cached encoding: the FaceEncoding's float32
+# array, its row in the stacked matrix and per-object overhead
+ENCODING_BYTES = 2 * ENCODING_SIZE * 4 + 256
+PERSON_BYTES = 256
+# Limit on the partitions each face is compared with in a `FaceIndex`, unset for exact matching
+FACE_INDEX_MAX_PROBES = int(environ['FACE_INDEX_MAX_PROBES']) if 'FACE_INDEX_MAX_PROBES' in environ else None
+
+
+class UserFaces:
+    """A user's people and their face encodings, as held in `FaceCache`.
+    The stacked `FaceMatrix` is built on first use and rebuilt after writes.
+    Users with at least `INDEX_MIN_ENCODINGS` encodings are matched with a
+    `FaceIndex` instead, which is built once and updated by writes in place."""
+    def __init__(self, people: dict[Person, list[FaceEncoding]], expires_at: float):
+        self.people = people
+        self.people_by_id = {person.id: person for person in people}
+        self.expires_at = expires_at
+        self._matrix: Optional[FaceMatrix] = None
+        self._index: Optional[FaceIndex] = None
+
+    @property
+    def matrix(self) -> FaceMatrix:
+        if self._matrix is None:
+            self._matrix = FaceMatrix.from_people(self.people)
+        return self._matrix
+
+    @property
+    def index(self) -> Union[FaceMatrix, FaceIndex]:
+        'Exact matrix for small users, partitioned index for large ones'
+        if self._index is None and self.num_encodings >= INDEX_MIN_ENCODINGS:
+            self._index = FaceIndex(self.people, max_probes=FACE_INDEX_MAX_PROBES)
+        return self._index if self._index is not None else self.matrix
+
+    @property
+    def num_encodings(self) -> int:
+        return sum(len(faces) for faces in self.people.values())
+
+    @property
+    def nbytes(self) -> int:
+        # The index's arrays are charged as allocated, with their spare and replaced rows
+        index_bytes = self._index.nbytes if self._index is not None else 0
+        return self.num_encodings * ENCODING_BYTES + len(self.people) * PERSON_BYTES + index_bytes
+
+    def snapshot(self) -> dict[Person, list[FaceEncoding]]:
+        'Copy of the person map which is safe to iterate while the cache is written to'
+        return {person: list(faces) for person, faces in self.people.items()}
+
+
+class FaceCache:
+    """LRU cache of `UserFaces` by user id, bounded by an estimated memory
+    budget and a time to live. `FaceDatabase` writes through it so that
+    cached users always reflect this process's own updates; the TTL bounds
+    how long updates made by other processes can go unseen.
+
+    The server therefore assumes it runs as a single worker process. When
+    a write finds that cached people were deleted elsewhere, the user is
+    invalidated and the faces are matched again, but new people created by
+    other processes stay unseen until the entry expires.
+    """
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries: OrderedDict[str, UserFaces] = OrderedDict()
+        self._entry_bytes: dict[str, int] = dict()
+        # Reverse mapping used by writes which only know a person id
+        self._person_users: dict[ObjectId, str] = dict()
+        # People created but not yet added to a user
+        self._new_people: dict[ObjectId, Person] = dict()
+        self._lock = RLock()
+
+    def get(self, user_id: str) -> Optional[UserFaces]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.expires_at < monotonic():
+                self._remove(user_id)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(cache='faces', result='miss')
+                return None
+            self.hits += 1
+            CACHE_LOOKUPS.inc(cache='faces', result='hit')
+            self._entries.move_to_end(user_id)
+            return entry
+
+    def put(self, user_id: str, people: dict[Person, list[FaceEncoding]]) -> UserFaces:
+        entry = UserFaces(people, monotonic() + self.ttl)
+        with self._lock:
+            self._remove(user_id)
+            self._entries[user_id] = entry
+            for person_id in entry.people_by_id:
+                self._person_users[person_id] = user_id
+            self._resize(user_id)
+        return entry
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._remove(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._entry_bytes.clear()
+            self._person_users.clear()
+            self._new_people.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'users': len(self._entries),
+                'bytes': self.nbytes,
+            }
+
+    def add_new_person(self, person: Person):
+        with self._lock:
+            self._new_people[person.id] = person
+
+    def add_person_to_user(self, user_id: str, person_id: ObjectId):
+        with self._lock:
+            person = self._new_people.pop(person_id, None)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            if person is None:
+                # Person was created elsewhere, so its name is unknown
+                self._remove(user_id)
+                return
+            entry.people[person] = []
+            entry.people_by_id[person_id] = person
+            entry._matrix = None
+            if entry._index is not None:
+                entry._index.add_person(person)
+            self._person_users[person_id] = user_id
+
+    def set_person_faces(self, person_id: ObjectId, face_encs: list[FaceEncoding]):
+        'Replace the encodings a person is matched by'
+        with self._lock:
+            user_id = self._person_users.get(person_id)
+            if user_id not in self._entries:
+                return
+            entry = self._entries[user_id]
+            person = entry.people_by_id[person_id]
+            entry.people[person] = list(face_encs)
+            entry._matrix = None
+            if entry._index is not None:
+                entry._index.set_person(person, face_encs)
+            self._resize(user_id)
+
+    def rename_person(self, user_id: str, person_id: ObjectId, name: str):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or person_id not in entry.people_by_id:
+                return
+            # Person hashes by id, so it can be renamed while used as a key
+            entry.people_by_id[person_id].name = name
+
+    def remove_person(self, user_id: str, person_id: ObjectId):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or person_id not in entry.people_by_id:
+                return
+            person = entry.people_by_id.pop(person_id)
+            del entry.people[person]
+            self._person_users.pop(person_id, None)
+            entry._matrix = None
+            if entry._index is not None:
+                entry._index.set_person(person, [])
+            self._resize(user_id)
+
+    def _remove(self, user_id: str):
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return
+        self.nbytes -= self._entry_bytes.pop(user_id)
+        for person_id in entry.people_by_id:
+            if self._person_users.get(person_id) == user_id:
+                del self._person_users[person_id]
+
+    def _resize(self, user_id: str):
+        'Update the size of an entry after a write, evicting least recently used users if over budget'
+        entry_bytes = self._entries[user_id].nbytes
+        self.nbytes += entry_bytes - self._entry_bytes.get(user_id, 0)
+        self._entry_bytes[user_id] = entry_bytes
+        while self.nbytes > self.max_bytes and len(self._entries) > 0:
+            self._remove(next(iter(self._entries)))
@@ -0,0 +1,211 @@
+from threading import Lock
+from typing import Optional
+
+import numpy as np
+
+from .face import ENCODING_SIZE, MAX_DISTANCE_ELEMENTS, TOLERANCE, face_distances
+from .util.models import ENCODING_DTYPE, FaceEncoding, Person
+
+# Users with fewer encodings are matched by exact search over a `FaceMatrix`
+INDEX_MIN_ENCODINGS = 5000
+# Average number of encodings in each partition. Small partitions have small
+# radii, so more of them can be ruled out for each face
+ENCODINGS_PER_LIST = 32
+# Iterations of k-means used to place the partitions' centroids
+KMEANS_ITERATIONS = 5
+# Encodings sampled per partition to train the centroids
+KMEANS_SAMPLES_PER_LIST = 16
+# Fraction of rows left by replaced encodings above which the arrays are compacted
+MAX_DEAD_FRACTION = 0.25
+
+
+class FaceIndex:
+    """A user's face encodings split into partitions around k-means centroids,
+    an IVF index, so that matching a face only scans the partitions which
+    can hold an encoding within tolerance of it.
+
+    Each partition keeps its radius, the furthest any member has been from
+    its centroid. By the triangle inequality, no encoding in a partition is
+    closer to a face than the face's distance to the centroid minus the
+    radius, so partitions further than that are skipped without missing a
+    match. `max_probes` optionally also limits each face to its closest
+    partitions, trading recall for speed.
+
+    A person's encodings are replaced in place as the user's faces change,
+    and the radii of the partitions they leave shrink to their remaining
+    members. Rows of replaced encodings are reclaimed once they are more
+    than `MAX_DEAD_FRACTION` of the arrays. The partitions are retrained
+    once the index has doubled or halved in size since they were trained.
+    """
+    def __init__(self, people: dict[Person, list[FaceEncoding]], max_probes: Optional[int] = None):
+        self.max_probes = max_probes
+        self.people: list[Person] = []
+        self._person_cols: dict[Person, int] = dict()
+        self._encodings = np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+        self._rows_person = np.empty(0, dtype=np.intp)
+        self._alive = np.empty(0, dtype=bool)
+        self._row_lists = np.empty(0, dtype=np.intp)
+        self._size = 0
+        self._num_alive = 0
+        self._lock = Lock()
+        # Number of encodings compared by the last `matches` call, for measuring pruning
+        self.last_scanned = 0
+        for person, faces in people.items():
+            self._add(person, faces)
+        self._train()
+
+    def __len__(self):
+        return self._num_alive
+
+    @property
+    def nbytes(self) -> int:
+        'Memory allocated by the arrays, including spare capacity and rows of replaced encodings'
+        return (self._encodings.nbytes + self._rows_person.nbytes + self._alive.nbytes
+                + self._row_lists.nbytes + sum(members.nbytes for members in self._members))
+
+    def add_person(self, person: Person):
+        with self._lock:
+            self._add_person(person)
+
+    def set_person(self, person: Person, faces: list[FaceEncoding]):
+        'Replace the encodings of a person, adding the new ones to the partitions they are closest to'
+        with self._lock:
+            self._add_person(person)
+            rows = np.flatnonzero(self._alive[:self._size]
+                                  & (self._rows_person[:self._size] == self._person_cols[person]))
+            self._alive[rows] = False
+            self._num_alive -= len(rows)
+            vacated_lists = np.unique(self._row_lists[rows])
+            for lst in vacated_lists:
+                self._members[lst] = self._members[lst][self._alive[self._members[lst]]]
+            self._fit_radii(vacated_lists)
+
+            start = self._size
+            self._add(person, faces)
+            if self._num_alive > 2 * self._trained_size or self._num_alive < self._trained_size // 2:
+                self._train()
+                return
+            self._assign(np.arange(start, self._size))
+            if self._size - self._num_alive > MAX_DEAD_FRACTION * self._size:
+                self._compact()
+                # Rows are renumbered, so each partition's members are found again
+                order = np.argsort(self._row_lists, kind='stable')
+                counts = np.bincount(self._row_lists, minlength=len(self._centroids))
+                self._members = np.split(order, np.cumsum(counts)[:-1])
+                self._fit_radii(np.arange(len(self._centroids)))
+
+    def matches(self, faces: np.ndarray, tolerance: float = TOLERANCE) -> np.ndarray:
+        """Whether each face is within tolerance of any encoding of each person.
+
+        Returns:
+            np.ndarray: (n_faces, n_people) boolean matrix
+        """
+        with self._lock:
+            matches = np.zeros((len(faces), len(self.people)), dtype=bool)
+            self.last_scanned = 0
+            if len(faces) == 0 or self._num_alive == 0:
+                return matches
+
+            centroid_dists = face_distances(self._centroids, faces)
+            # Lower bound on the distance from each face to any member of each partition
+            probes = centroid_dists - self._radii[None, :] <= tolerance
+            if self.max_probes is not None and self.max_probes < len(self._centroids):
+                closest = np.argpartition(centroid_dists, self.max_probes - 1, axis=1)[:, :self.max_probes]
+                nearby = np.zeros_like(probes)
+                np.put_along_axis(nearby, closest, True, axis=1)
+                probes &= nearby
+
+            # Compare each partition with every face probing it at once
+            for lst in np.flatnonzero(probes.any(axis=0)):
+                rows = self._members[lst]
+                if len(rows) == 0:
+                    continue
+                face_idxs = np.flatnonzero(probes[:, lst])
+                chunk = max(1, MAX_DISTANCE_ELEMENTS // len(rows))
+                for start in range(0, len(face_idxs), chunk):
+                    chunk_idxs = face_idxs[start:start + chunk]
+                    dists = face_distances(self._encodings[rows], faces[chunk_idxs])
+                    face_hits, row_hits = np.nonzero(dists <= tolerance)
+                    matches[chunk_idxs[face_hits], self._rows_person[rows[row_hits]]] = True
+                self.last_scanned += len(rows) * len(face_idxs)
+            return matches
+
+    def _add_person(self, person: Person):
+        if person not in self._person_cols:
+            self._person_cols[person] = len(self.people)
+            self.people.append(person)
+
+    def _add(self, person: Person, faces: list[FaceEncoding]):
+        self._add_person(person)
+        if len(faces) == 0:
+            return
+        end = self._size + len(faces)
+        if end > len(self._encodings):
+            # Grow the arrays geometrically so adding faces is amortized constant time
+            capacity = max(end, 2 * len(self._encodings))
+            self._encodings = np.resize(self._encodings, (capacity, ENCODING_SIZE))
+            self._rows_person = np.resize(self._rows_person, capacity)
+            self._alive = np.resize(self._alive, capacity)
+            self._row_lists = np.resize(self._row_lists, capacity)
+        self._encodings[self._size:end] = [face.encoding for face in faces]
+        self._rows_person[self._size:end] = self._person_cols[person]
+        self._alive[self._size:end] = True
+        self._size = end
+        self._num_alive += len(faces)
+
+    def _compact(self):
+        'Drop the rows of replaced encodings, keeping the order of the others'
+        rows = np.flatnonzero(self._alive[:self._size])
+        self._encodings = self._encodings[rows]
+        self._rows_person = self._rows_person[rows]
+        self._row_lists = self._row_lists[rows]
+        self._alive = np.ones(len(rows), dtype=bool)
+        self._size = len(rows)
+
+    def _fit_radii(self, lists: np.ndarray):
+        'Set the radii of partitions to the distance of their furthest member, as members may have left'
+        self._radii[lists] = 0
+        rows = np.concatenate([self._members[lst] for lst in lists]) if len(lists) > 0 else []
+        chunk = max(1, MAX_DISTANCE_ELEMENTS // ENCODING_SIZE)
+        for start in range(0, len(rows), chunk):
+            chunk_rows = rows[start:start + chunk]
+            chunk_lists = self._row_lists[chunk_rows]
+            dists = np.linalg.norm(self._encodings[chunk_rows] - self._centroids[chunk_lists], axis=1)
+            np.maximum.at(self._radii, chunk_lists, dists)
+
+    def _train(self):
+        'Place the centroids with k-means over a sample of the encodings, then partition every encoding'
+        self._compact()
+        rows = np.arange(self._size)
+        num_lists = max(1, len(rows) // ENCODINGS_PER_LIST)
+        rng = np.random.default_rng(0)
+        sample = self._encodings[rng.permutation(rows)[:num_lists * KMEANS_SAMPLES_PER_LIST]]
+        centroids = sample[:num_lists].copy()
+        for _ in range(KMEANS_ITERATIONS if len(sample) > num_lists else 0):
+            assignments = face_distances(centroids, sample).argmin(axis=1)
+            counts = np.bincount(assignments, minlength=len(centroids))
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            # Partitions left empty keep their centroid
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+        self._centroids = centroids
+        self._radii = np.zeros(len(centroids), dtype=ENCODING_DTYPE)
+        self._members = [np.empty(0, dtype=np.intp) for _ in centroids]
+        self._trained_size = len(rows)
+        self._assign(rows)
+
+    def _assign(self, rows: np.ndarray):
+        'Add rows to the partition with the closest centroid, growing its radius to cover them'
+        if len(rows) == 0 or len(self._centroids) == 0:
+            return
+        chunk = max(1, MAX_DISTANCE_ELEMENTS // len(self._centroids))
+        for start in range(0, len(rows), chunk):
+            chunk_rows = rows[start:start + chunk]
+            dists = face_distances(self._centroids, self._encodings[chunk_rows])
+            lists = dists.argmin(axis=1)
+            self._row_lists[chunk_rows] = lists
+            np.maximum.at(self._radii, lists, dists[np.arange(len(lists)), lists])
+            for lst in np.unique(lists):
+                self._members[lst] = np.concatenate([self._members[lst], chunk_rows[lists == lst]])
@@ -0,0 +1,132 @@
+from abc import ABC, abstractmethod
+from typing import Iterator, Optional, Union
+
+from bson import ObjectId
+from fastapi import HTTPException
+
+from .face import FaceMatrix
+from .face_cache import FaceCache
+from .face_index import FaceIndex
+from .metrics import timed
+from .util.models import FaceEncoding, Person
+
+
+class PeopleNotFound(HTTPException):
+    '''Raised by `insert_matched_faces` when people faces were matched to have been
+    deleted since the user's faces were read, so the faces can be matched again'''
+    def __init__(self, person_ids: list[ObjectId]):
+        super().__init__(status_code=404, detail=f"{len(person_ids)} people not found")
+        self.person_ids = person_ids
+
+
+class FaceStore(ABC):
+    """Storage of users' people, their face encodings and the images they
+    are in, which the endpoints are written against. `FaceDatabase` stores
+    them in MongoDB and `LocalFaceDatabase` in local files.
+
+    People are matched by the representative encodings of their
+    `PersonSummary`, read through `cache`, which every write keeps up to
+    date. Implementations load them with `_load_user_face_encodings`.
+    """
+    def __init__(self, cache_max_bytes: int = 256 * 2**20, cache_ttl: float = 600):
+        # Users' face encodings, kept up to date by every write
+        self.cache = FaceCache(cache_max_bytes, cache_ttl)
+
+    @abstractmethod
+    def reset(self):
+        'Delete every user, person and encoding'
+
+    @abstractmethod
+    def create_user(self, user_id: str):
+        ...
+
+    @abstractmethod
+    def get_existing_image_ids(self, user_id: str, image_ids: list[str]) -> list[str]:
+        'Return which of `image_ids` the user has already processed'
+
+    @abstractmethod
+    def insert_matched_faces(self,
+                             user_id: str,
+                             matched_faces: dict[Person, list[FaceEncoding]],
+                             new_people_faces: dict[str, list[FaceEncoding]]) -> list[ObjectId]:
+        '''Add faces matched to the user's existing people, and create a person for
+        each list of new faces, linking every image to its people. Returns the ids of
+        the new people.
+
+        Raises `PeopleNotFound`, writing nothing and dropping the user from the cache,
+        if any of the matched people no longer exist.'''
+
+    @abstractmethod
+    def get_user_people(self,
+                        user_id: str,
+                        after: Optional[ObjectId] = None,
+                        limit: Optional[int] = None) -> Union[list[Person], None]:
+        '''A page of the user's people in order of creation, starting after the
+        person with id `after`, or None if the user does not exist.'''
+
+    @abstractmethod
+    def iter_people_images(self,
+                           people: list[Person],
+                           image_limit: Optional[int] = None) -> Iterator[tuple[Person, list[str]]]:
+        'Yield each person with the ids of the images they are in, at most `image_limit` of them'
+
+    @abstractmethod
+    def set_person_name(self, user_id: str, person_id: str, name: str):
+        ...
+
+    @abstractmethod
+    def delete_user_images(self, user_id: str, image_ids: list[str]) -> dict[str, list[ObjectId]]:
+        '''Delete a batch of the user's images, deleting people left with none.
+        Returns the ids of the people in each deleted image. Images which
+        are not found are left out.'''
+
+    def delete_user_image(self, user_id: str, image_id: str) -> list[ObjectId]:
+        # Returns the person ids of people whose photos were deleted
+        # Since a single photo can have multiple faces, multiple people can be updated
+        return self.delete_user_images(user_id, [image_id]).get(image_id, [])
+
+    @abstractmethod
+    def _load_user_face_encodings(self, user_id: str) -> Union[dict[Person, list[FaceEncoding]], None]:
+        '''Each of the user's people, in order of creation, and the representative
+        encodings they are matched by, or None if the user does not exist.'''
+
+    @timed('db_get_user_face_encodings')
+    def get_user_face_encodings(self, user_id: str) -> dict[Person, list[FaceEncoding]]:
+        '''
+        Given a user id, return a mapping of `person_id` to their face `img_encodings`.
+        Each `img_encoding` is an object with `img` and `encoding` attributes/keys.
+        '''
+        user_faces = self.cache.get(user_id)
+        if user_faces is not None:
+            return user_faces.snapshot()
+        people_face_encodings = self._load_user_face_encodings(user_id)
+        if people_face_encodings is None:
+            return None
+        return self.cache.put(user_id, people_face_encodings).snapshot()
+
+    @timed('db_get_user_face_matrix')
+    def get_user_face_matrix(self, user_id: str) -> Union[FaceMatrix, None]:
+        '''
+        Given a user id, return all of their face encodings stacked into a `FaceMatrix`
+        for matching, reusing the cached matrix when the user has not changed.
+        '''
+        user_faces = self._get_user_faces(user_id)
+        return None if user_faces is None else user_faces.matrix
+
+    @timed('db_get_user_face_index')
+    def get_user_face_index(self, user_id: str) -> Union[FaceMatrix, FaceIndex, None]:
+        '''
+        Given a user id, return their face encodings ready for matching: a `FaceMatrix`
+        for users with few encodings, otherwise a `FaceIndex` kept up to date by writes.
+        '''
+        user_faces = self._get_user_faces(user_id)
+        return None if user_faces is None else user_faces.index
+
+    def _get_user_faces(self, user_id: str):
+        user_faces = self.cache.get(user_id)
+        if user_faces is None:
+            people_face_encodings = self._load_user_face_encodings(user_id)
+            if people_face_encodings is None:
+                return None
+            user_faces = self.cache.put(user_id, people_face_encodings)
+        return user_faces
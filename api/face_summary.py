@@ -0,0 +1,89 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from bson import Binary
+
+from .face import ENCODING_SIZE, face_distances
+from .util.models import ENCODING_DTYPE, FaceEncoding, decode_encoding
+
+# Largest number of encodings kept to represent a person when matching
+MAX_REPRESENTATIVES = 32
+
+
+def select_representatives(faces: list[FaceEncoding],
+                           centroid: np.ndarray,
+                           max_count: int = MAX_REPRESENTATIVES) -> list[FaceEncoding]:
+    """Choose up to `max_count` faces which cover all of them, by farthest
+    point traversal: start from the face closest to the centroid, then
+    repeatedly take the face furthest from every face taken so far."""
+    if len(faces) <= max_count:
+        return list(faces)
+    encodings = np.array([face.encoding for face in faces], dtype=ENCODING_DTYPE)
+    chosen = [int(face_distances(encodings, centroid[None, :].astype(ENCODING_DTYPE)).argmin())]
+    # Distance from each face to the closest face chosen so far
+    min_dists = face_distances(encodings[chosen], encodings)[:, 0]
+    for _ in range(max_count - 1):
+        chosen.append(int(min_dists.argmax()))
+        np.minimum(min_dists, face_distances(encodings[chosen[-1:]], encodings)[:, 0], out=min_dists)
+    return [faces[i] for i in chosen]
+
+
+@dataclass
+class PersonSummary:
+    """What is kept of a person's faces for matching: the mean of all of
+    their encodings and a bounded set of representative encodings. Every
+    encoding is also stored separately, to rebuild the summary from."""
+    centroid: np.ndarray
+    count: int
+    representatives: list[FaceEncoding]
+
+    @staticmethod
+    def from_encodings(faces: list[FaceEncoding]) -> 'PersonSummary':
+        if len(faces) == 0:
+            return PersonSummary(np.zeros(ENCODING_SIZE, dtype=np.float64), 0, [])
+        centroid = np.mean([face.encoding for face in faces], axis=0, dtype=np.float64)
+        return PersonSummary(centroid, len(faces), select_representatives(faces, centroid))
+
+    def add(self, faces: list[FaceEncoding]) -> 'PersonSummary':
+        'Summary after adding faces, choosing representatives from the old ones and the new faces'
+        if len(faces) == 0:
+            return self
+        count = self.count + len(faces)
+        total = self.centroid * self.count + np.sum([face.encoding for face in faces], axis=0, dtype=np.float64)
+        centroid = total / count
+        return PersonSummary(centroid, count, select_representatives(self.representatives + faces, centroid))
+
+    def remove(self, faces: list[FaceEncoding]) -> Optional['PersonSummary']:
+        '''Summary after removing faces, or None if too few representatives are
+        left, since replacing them needs all of the person's remaining encodings.'''
+        if len(faces) == 0:
+            return self
+        count = self.count - len(faces)
+        image_ids = {face.image_id for face in faces}
+        representatives = [face for face in self.representatives if face.image_id not in image_ids]
+        if count <= 0:
+            return PersonSummary.from_encodings([])
+        if len(representatives) < min(count, MAX_REPRESENTATIVES):
+            return None
+        total = self.centroid * self.count - np.sum([face.encoding for face in faces], axis=0, dtype=np.float64)
+        return PersonSummary(total / count, count, representatives)
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'centroid': Binary(np.ascontiguousarray(self.centroid, dtype=ENCODING_DTYPE).tobytes()),
+            'representatives': [face.to_dict() for face in self.representatives],
+        }
+
+    @staticmethod
+    def from_dict(person_doc: dict) -> 'PersonSummary':
+        '''Read the summary of a person document. People stored before summaries
+        have every encoding in an `encodings` array, which is summarized instead.'''
+        if 'count' not in person_doc:
+            return PersonSummary.from_encodings(
+                [FaceEncoding.from_dict(face_enc) for face_enc in person_doc.get('encodings', [])])
+        return PersonSummary(
+            decode_encoding(person_doc['centroid']).astype(np.float64),
+            person_doc['count'],
+            [FaceEncoding.from_dict(face_enc) for face_enc in person_doc['representatives']])
@@ -0,0 +1,126 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Lock
+from time import monotonic
+from typing import Callable, Optional
+from uuid import uuid4
+
+from fastapi import HTTPException
+
+from .util.models import ImageFile, JobStatus
+
+
+@dataclass
+class Job:
+    id: str
+    user_id: str
+    # Images not processed yet, released chunk by chunk
+    images: list[ImageFile]
+    images_total: int
+    status: str = 'queued'
+    images_done: int = 0
+    faces_found: int = 0
+    error: Optional[str] = None
+    submitted_at: float = field(default_factory=monotonic)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def to_status(self) -> JobStatus:
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = (self.finished_at or monotonic()) - self.started_at
+        return JobStatus(id=self.id, status=self.status, images_total=self.images_total,
+                         images_done=self.images_done, faces_found=self.faces_found,
+                         error=self.error, elapsed=elapsed)
+
+
+class JobQueue:
+    """Processes batches of a user's images in the background, on a bounded
+    pool of worker threads, so large imports do not hold a request open.
+
+    Each job's images are passed to `process` in chunks of `chunk_size`,
+    so faces in each chunk are matched against the people created from the
+    chunks before it, and progress is visible after every chunk. Jobs of
+    the same user run one at a time in the order they were submitted, as
+    concurrent jobs would each create new people for the same faces.
+
+    At most `max_pending` jobs are queued or running, holding their images
+    in memory. Finished jobs are kept for `ttl` seconds for their status to be read.
+    """
+    def __init__(self,
+                 process: Callable[[str, list[ImageFile]], int],
+                 workers: int = 2,
+                 max_pending: int = 20,
+                 chunk_size: int = 50,
+                 ttl: float = 3600):
+        self.process_fn = process
+        self.max_pending = max_pending
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='face-job')
+        self._jobs: dict[str, Job] = dict()
+        # Jobs waiting for the running job of their user to finish
+        self._user_queues: dict[str, deque[Job]] = dict()
+        self._lock = Lock()
+
+    def submit(self, user_id: str, images: list[ImageFile]) -> Job:
+        job = Job(uuid4().hex, user_id, images, len(images))
+        with self._lock:
+            self._expire()
+            if sum(not pending.finished for pending in self._jobs.values()) >= self.max_pending:
+                raise HTTPException(detail="Too many jobs pending, try again later", status_code=503)
+            self._jobs[job.id] = job
+            if user_id in self._user_queues:
+                self._user_queues[user_id].append(job)
+            else:
+                self._user_queues[user_id] = deque()
+                self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def shutdown(self):
+        'Stop once the running jobs finish, dropping queued ones'
+        with self._lock:
+            self._user_queues.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job: Job):
+        job.started_at = monotonic()
+        job.status = 'running'
+        status, error = 'done', None
+        try:
+            while len(job.images) > 0:
+                chunk = job.images[:self.chunk_size]
+                job.faces_found += self.process_fn(job.user_id, chunk)
+                job.images = job.images[len(chunk):]
+                job.images_done += len(chunk)
+        except HTTPException as err:
+            status, error = 'failed', str(err.detail)
+        except Exception as err:
+            status, error = 'failed', repr(err)
+        job.images = []
+        # Finished jobs must have their finish time for `_expire`
+        job.finished_at = monotonic()
+        job.error = error
+        job.status = status
+        with self._lock:
+            queue = self._user_queues.get(job.user_id)
+            if queue is not None and len(queue) > 0:
+                self._executor.submit(self._run, queue.popleft())
+            else:
+                self._user_queues.pop(job.user_id, None)
+
+    def _expire(self):
+        now = monotonic()
+        for job_id in [job.id for job in self._jobs.values()
+                       if job.finished and job.finished_at + self.ttl < now]:
+            del self._jobs[job_id]
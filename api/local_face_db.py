@@ -0,0 +1,328 @@
+import json
+import os
+import shutil
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import RLock
+from typing import Iterator, Optional, Union
+
+import numpy as np
+from bson import ObjectId
+from fastapi import HTTPException
+
+from .face import ENCODING_SIZE
+from .face_store import FaceStore, PeopleNotFound
+from .face_summary import PersonSummary
+from .metrics import timed
+from .util.models import ENCODING_DTYPE, FaceEncoding, Person
+
+ROW_BYTES = ENCODING_SIZE * ENCODING_DTYPE.itemsize
+
+# Users, people and links from encodings to people and images are stored in
+# `faces.sqlite`. `encodings/<user>.f32` holds each user's encodings as rows
+# of a float32 matrix, numbered from 0 in the order they were appended.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS people (
+    id TEXT PRIMARY KEY,          -- ObjectId in hex, which sorts in order of creation
+    user INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    count INTEGER NOT NULL,       -- number of encodings
+    centroid BLOB NOT NULL,       -- float64
+    representatives TEXT NOT NULL -- JSON [[row, image_id]], at most MAX_REPRESENTATIVES
+);
+CREATE INDEX IF NOT EXISTS people_user ON people (user, id);
+CREATE TABLE IF NOT EXISTS encodings (
+    user INTEGER NOT NULL,
+    row INTEGER NOT NULL,
+    person_id TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    PRIMARY KEY (user, row)
+);
+CREATE INDEX IF NOT EXISTS encodings_person ON encodings (person_id, row);
+CREATE INDEX IF NOT EXISTS encodings_image ON encodings (user, image_id);
+'''
+
+
+@dataclass
+class StoredEncoding(FaceEncoding):
+    'An encoding with the row of the user\'s matrix it is stored in'
+    row: int
+
+
+class LocalFaceDatabase(FaceStore):
+    """Stores faces in a local directory, for edge deployments and tests
+    without MongoDB. Each user's encodings are appended to their own matrix
+    file, which is memory-mapped to read them, so loading a user involves no
+    parsing and the encodings are paged in from the OS's file cache.
+
+    Rows of deleted images are only unlinked, so matrix files keep growing
+    with every upload. Writes hold a lock and run in a SQLite transaction,
+    so only one process should use a directory at a time.
+    """
+    def __init__(self, path: str, reset: bool = False,
+                 cache_max_bytes: int = 256 * 2**20, cache_ttl: float = 600):
+        super().__init__(cache_max_bytes, cache_ttl)
+        self.path = path
+        os.makedirs(os.path.join(path, 'encodings'), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(path, 'faces.sqlite'), check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        # Guards the connection, which is shared by every thread, and appends to matrix files
+        self._lock = RLock()
+        # Each user's mapped matrix, remapped once rows are appended past its end
+        self._matrices: dict[int, np.ndarray] = dict()
+        if reset:
+            print("!! DELETING ALL USERS !!")
+            self.reset()
+
+    def reset(self):
+        'Delete every table and matrix file and recreate them'
+        print("Recreating tables...", end=" ")
+        with self._lock:
+            self.cache.clear()
+            self._matrices.clear()
+            self._db.executescript('DROP TABLE IF EXISTS users; DROP TABLE IF EXISTS people; '
+                                   'DROP TABLE IF EXISTS encodings;')
+            shutil.rmtree(os.path.join(self.path, 'encodings'))
+            os.makedirs(os.path.join(self.path, 'encodings'))
+            self._db.executescript(SCHEMA)
+        print("done!")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                yield
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _user(self, user_id: str) -> Optional[int]:
+        row = self._db.execute('SELECT id FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def _matrix_path(self, user: int) -> str:
+        return os.path.join(self.path, 'encodings', f'{user}.f32')
+
+    def _matrix(self, user: int, num_rows: int) -> np.ndarray:
+        'The user\'s matrix of encodings, mapped read only, with at least `num_rows` rows'
+        matrix = self._matrices.get(user)
+        if matrix is None or len(matrix) < num_rows:
+            path = self._matrix_path(user)
+            size = os.path.getsize(path) // ROW_BYTES if os.path.exists(path) else 0
+            if size == 0:
+                matrix = np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+            else:
+                # Arrays previously mapped stay valid, as rows are only ever appended
+                matrix = np.memmap(path, dtype=ENCODING_DTYPE, mode='r', shape=(size, ENCODING_SIZE))
+            self._matrices[user] = matrix
+        return matrix
+
+    def _append(self, user: int, faces: list[FaceEncoding]) -> list[StoredEncoding]:
+        'Append encodings to the end of the user\'s matrix'
+        with open(self._matrix_path(user), 'ab') as f:
+            size = f.tell()
+            if size % ROW_BYTES != 0:
+                # Drop a row left partly written by a crash
+                f.truncate(size - size % ROW_BYTES)
+            start = size // ROW_BYTES
+            encodings = np.array([face.encoding for face in faces], dtype=ENCODING_DTYPE)
+            f.write(encodings.tobytes())
+        return [StoredEncoding(face.image_id, encoding, start + i)
+                for i, (face, encoding) in enumerate(zip(faces, encodings))]
+
+    def _stored_encodings(self, user: int, rows: list[tuple[int, str]]) -> list[StoredEncoding]:
+        'Encodings of (row, image_id) pairs, as views of the mapped matrix'
+        if len(rows) == 0:
+            return []
+        matrix = self._matrix(user, max(row for row, _ in rows) + 1)
+        return [StoredEncoding(image_id, matrix[row], row) for row, image_id in rows]
+
+    def _summaries(self, user: int, person_ids: list[ObjectId]) -> dict[ObjectId, PersonSummary]:
+        'Summaries of those of the user\'s people who exist'
+        people_rows = self._db.execute(
+            'SELECT id, count, centroid, representatives FROM people '
+            'WHERE user = ? AND id IN (SELECT value FROM json_each(?))',
+            (user, json.dumps([str(person_id) for person_id in person_ids])))
+        return {
+            ObjectId(person_id): PersonSummary(
+                np.frombuffer(centroid, dtype=np.float64), count,
+                self._stored_encodings(user, json.loads(representatives)))
+            for person_id, count, centroid, representatives in people_rows
+        }
+
+    @staticmethod
+    def _summary_values(summary: PersonSummary) -> tuple[int, bytes, str]:
+        return (summary.count, np.ascontiguousarray(summary.centroid, dtype=np.float64).tobytes(),
+                json.dumps([[face.row, face.image_id] for face in summary.representatives]))
+
+    @timed('db_create_user')
+    def create_user(self, user_id: str):
+        with self._lock:
+            return self._db.execute('INSERT INTO users (user_id) VALUES (?)', (user_id,)).lastrowid
+
+    @timed('db_get_existing_image_ids')
+    def get_existing_image_ids(self, user_id: str, image_ids: list[str]) -> list[str]:
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT DISTINCT image_id FROM encodings JOIN users ON encodings.user = users.id '
+                'WHERE users.user_id = ? AND image_id IN (SELECT value FROM json_each(?))',
+                (user_id, json.dumps(image_ids)))
+            return [image_id for image_id, in rows]
+
+    def _load_user_face_encodings(self, user_id: str) -> Union[dict[Person, list[FaceEncoding]], None]:
+        with self._lock:
+            user = self._user(user_id)
+            if user is None:
+                return None
+            people_rows = self._db.execute(
+                'SELECT id, name, representatives FROM people WHERE user = ? ORDER BY id', (user,)).fetchall()
+            return {Person(ObjectId(person_id), name): self._stored_encodings(user, json.loads(representatives))
+                    for person_id, name, representatives in people_rows}
+
+    @timed('db_insert_matched_faces')
+    def insert_matched_faces(self,
+                             user_id: str,
+                             matched_faces: dict[Person, list[FaceEncoding]],
+                             new_people_faces: dict[str, list[FaceEncoding]]) -> list[ObjectId]:
+        '''
+        Append every encoding to the user's matrix, then link them to their
+        people and images and write the people's summaries in one transaction.
+        Encodings appended by a transaction which fails are never linked.
+        '''
+        new_people = [Person(ObjectId(), name) for name in new_people_faces.keys()]
+        with self._transaction():
+            user = self._user(user_id)
+            if user is None:
+                raise HTTPException(status_code=404, detail=f"User ID {user_id} not found")
+            summaries = self._summaries(user, [person.id for person in matched_faces])
+            if len(summaries) != len(matched_faces):
+                # The cached people are out of date, so they are read again for the retry
+                self.cache.invalidate(user_id)
+                raise PeopleNotFound([person.id for person in matched_faces if person.id not in summaries])
+
+            all_people_faces = list(zip([*matched_faces.keys(), *new_people],
+                                        [*matched_faces.values(), *new_people_faces.values()]))
+            stored = iter(self._append(user, [face for _, face_encs in all_people_faces for face in face_encs]))
+            people_stored = [(person, [next(stored) for _ in face_encs]) for person, face_encs in all_people_faces]
+            self._db.executemany(
+                'INSERT INTO encodings (user, row, person_id, image_id) VALUES (?, ?, ?, ?)',
+                [(user, face.row, str(person.id), face.image_id)
+                 for person, face_encs in people_stored for face in face_encs])
+
+            summaries = {person: summaries[person.id].add(face_encs)
+                         for person, face_encs in people_stored[:len(matched_faces)]}
+            self._db.executemany(
+                'UPDATE people SET count = ?, centroid = ?, representatives = ? WHERE id = ?',
+                [(*self._summary_values(summary), str(person.id)) for person, summary in summaries.items()])
+            new_summaries = [PersonSummary.from_encodings(face_encs)
+                             for _, face_encs in people_stored[len(matched_faces):]]
+            self._db.executemany(
+                'INSERT INTO people (id, user, name, count, centroid, representatives) VALUES (?, ?, ?, ?, ?, ?)',
+                [(str(person.id), user, person.name, *self._summary_values(summary))
+                 for person, summary in zip(new_people, new_summaries)])
+
+        for person, summary in summaries.items():
+            self.cache.set_person_faces(person.id, summary.representatives)
+        for person, summary in zip(new_people, new_summaries):
+            self.cache.add_new_person(person)
+            self.cache.add_person_to_user(user_id, person.id)
+            self.cache.set_person_faces(person.id, summary.representatives)
+        return [person.id for person in new_people]
+
+    @timed('db_get_user_people')
+    def get_user_people(self,
+                        user_id: str,
+                        after: Optional[ObjectId] = None,
+                        limit: Optional[int] = None) -> Union[list[Person], None]:
+        with self._lock:
+            user = self._user(user_id)
+            if user is None:
+                return None
+            # A limit of -1 is no limit
+            people_rows = self._db.execute(
+                'SELECT id, name FROM people WHERE user = ? AND id > ? ORDER BY id LIMIT ?',
+                (user, '' if after is None else str(after), -1 if limit is None else limit))
+            return [Person(ObjectId(person_id), name) for person_id, name in people_rows]
+
+    def iter_people_images(self,
+                           people: list[Person],
+                           image_limit: Optional[int] = None) -> Iterator[tuple[Person, list[str]]]:
+        for person in people:
+            with self._lock:
+                image_rows = self._db.execute(
+                    'SELECT image_id FROM encodings WHERE person_id = ? ORDER BY row LIMIT ?',
+                    (str(person.id), -1 if image_limit is None else image_limit))
+                image_ids = [image_id for image_id, in image_rows]
+            yield person, image_ids
+
+    @timed('db_set_person_name')
+    def set_person_name(self, user_id: str, person_id: str, name: str):
+        with self._lock:
+            user = self._user(user_id)
+            if user is None:
+                raise HTTPException(status_code=404, detail=f"User ID {user_id} not found")
+            num_updated = self._db.execute(
+                'UPDATE people SET name = ? WHERE id = ? AND user = ?', (name, person_id, user)).rowcount
+            if num_updated == 0:
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"User {user_id} does not have person with id {person_id}")
+        self.cache.rename_person(user_id, ObjectId(person_id), name)
+        return True
+
+    @timed('db_delete_user_images')
+    def delete_user_images(self, user_id: str, image_ids: list[str]) -> dict[str, list[ObjectId]]:
+        '''
+        Unlink a batch of the user's images from their people in one transaction,
+        updating each person's summary, or deleting them once they have no images left.
+        '''
+        with self._transaction():
+            user = self._user(user_id)
+            if user is None:
+                return {}
+            images_filter = 'user = ? AND image_id IN (SELECT value FROM json_each(?))'
+            encoding_rows = self._db.execute(
+                f'SELECT row, person_id, image_id FROM encodings WHERE {images_filter} ORDER BY row',
+                (user, json.dumps(image_ids))).fetchall()
+            if len(encoding_rows) == 0:
+                return {}
+            self._db.execute(f'DELETE FROM encodings WHERE {images_filter}', (user, json.dumps(image_ids)))
+
+            image_people: dict[str, dict[ObjectId, None]] = dict()
+            removed: dict[ObjectId, list[tuple[int, str]]] = dict()
+            for row, person_id, image_id in encoding_rows:
+                person_id = ObjectId(person_id)
+                image_people.setdefault(image_id, dict())[person_id] = None
+                removed.setdefault(person_id, []).append((row, image_id))
+
+            summaries = self._summaries(user, list(removed))
+            for person_id in summaries:
+                summary = summaries[person_id].remove(self._stored_encodings(user, removed[person_id]))
+                if summary is None:
+                    # Too few representatives are left, so choose them again from every remaining encoding
+                    rows = self._db.execute(
+                        'SELECT row, image_id FROM encodings WHERE person_id = ? ORDER BY row', (str(person_id),))
+                    summary = PersonSummary.from_encodings(self._stored_encodings(user, rows.fetchall()))
+                summaries[person_id] = summary
+
+            self._db.executemany('DELETE FROM people WHERE id = ?', [
+                (str(person_id),) for person_id, summary in summaries.items() if summary.count == 0])
+            self._db.executemany(
+                'UPDATE people SET count = ?, centroid = ?, representatives = ? WHERE id = ?',
+                [(*self._summary_values(summary), str(person_id))
+                 for person_id, summary in summaries.items() if summary.count > 0])
+
+        for person_id, summary in summaries.items():
+            if summary.count == 0:
+                self.cache.remove_person(user_id, person_id)
+            else:
+                self.cache.set_person_faces(person_id, summary.representatives)
+        return {image_id: list(people) for image_id, people in image_people.items()}
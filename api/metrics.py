@@ -0,0 +1,141 @@
+"""Counters and latency histograms for each stage of the request pipeline,
+rendered in the Prometheus text format by `GET /metrics`.
+
+Set `METRICS=0` to turn instrumentation off, in which case timing and
+counting return straight away.
+"""
+import bisect
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from os import environ
+from threading import Lock
+from time import perf_counter
+
+ENABLED = environ.get('METRICS', '1') == '1'
+# Upper bounds in seconds, spanning cache lookups to large batches
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry: list['Metric'] = []
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = Lock()
+        _registry.append(self)
+
+    def _label_values(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, values: tuple[str, ...], **extra: str) -> str:
+        pairs = [*zip(self.labels, values), *extra.items()]
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join(f'{label}="{value}"' for label, value in pairs) + '}'
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}', *self._samples()]
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple[str, ...], float] = dict()
+
+    def inc(self, amount: float = 1, **labels: str):
+        if not ENABLED:
+            return
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            return [f'{self.name}{self._format_labels(key)} {value}' for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # Per label values: count in each bucket (and above the last), sum and count
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = dict()
+
+    def observe(self, value: float, **labels: str):
+        if not ENABLED:
+            return
+        key = self._label_values(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bucket] += 1
+            total[0] += value
+
+    def time(self, **labels: str):
+        'Context manager which observes the time taken by its block'
+        if not ENABLED:
+            return nullcontext()
+        return self._time(labels)
+
+    @contextmanager
+    def _time(self, labels: dict[str, str]):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def _samples(self) -> list[str]:
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip([*self.buckets, '+Inf'], counts):
+                    cumulative += count
+                    samples.append(f'{self.name}_bucket{self._format_labels(key, le=bound)} {cumulative}')
+                samples.append(f'{self.name}_sum{self._format_labels(key)} {total[0]}')
+                samples.append(f'{self.name}_count{self._format_labels(key)} {cumulative}')
+        return samples
+
+
+STAGE_SECONDS = Histogram(
+    'photo_api_stage_seconds', 'Time spent in each stage of processing requests', ('stage',))
+REQUEST_SECONDS = Histogram(
+    'photo_api_request_seconds', 'Time taken to respond to requests', ('method', 'path', 'status'))
+IMAGES = Counter('photo_api_images_total', 'Images received', ('endpoint',))
+FACES = Counter('photo_api_faces_total', 'Faces found in processed images')
+IMAGES_WITHOUT_FACES = Counter('photo_api_images_without_faces_total', 'Processed images in which no face was found')
+PEOPLE_CREATED = Counter('photo_api_people_created_total', 'People created from unmatched faces')
+CACHE_LOOKUPS = Counter('photo_api_cache_lookups_total', 'Cache lookups by cache and result', ('cache', 'result'))
+
+
+def timed(stage: str):
+    'Decorator which records the time taken by every call of a function as a stage'
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                STAGE_SECONDS.observe(perf_counter() - start, stage=stage)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    'Every metric in the Prometheus text exposition format'
+    return '\n'.join(line for metric in _registry for line in metric.render()) + '\n'
@@ -0,0 +1,20 @@
+"""One-shot migration of face encodings stored as stringified lists
+to the binary float32 format written by `FaceEncoding.to_dict`.
+
+Usage: 'python -m api.migrate_encodings [--local]'
+"""
+import sys
+
+from .face_db import FaceDatabase
+
+
+def main():
+    local = '--local' in sys.argv[1:]
+    face_db = FaceDatabase(local=local)
+    print("Migrating face encodings to binary float32...", end=" ")
+    num_updated = face_db.migrate_encodings()
+    print(f"done! Updated {num_updated} people.")
+
+
+if __name__ == '__main__':
+    main()
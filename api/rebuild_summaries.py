@@ -0,0 +1,22 @@
+"""Maintenance command which recomputes every person's summary (centroid
+and representative encodings) from all of their stored encodings, first
+moving encodings still stored in people documents into the `encodings`
+collection.
+
+Usage: 'python -m api.rebuild_summaries [--local]'
+"""
+import sys
+
+from .face_db import FaceDatabase
+
+
+def main():
+    local = '--local' in sys.argv[1:]
+    face_db = FaceDatabase(local=local)
+    print("Rebuilding people's summaries...", end=" ")
+    num_summarized = face_db.rebuild_summaries()
+    print(f"done! Summarized {num_summarized} people.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from typing import Optional
+
+import msgpack
+
+from .metrics import CACHE_LOOKUPS
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    version TEXT NOT NULL,
+    value BLOB NOT NULL,
+    used_at REAL NOT NULL -- Unix time of the last write or disk hit
+);
+CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at);
+'''
+# Rows deleted at once when the database is over its size limit
+EVICT_BATCH = 256
+
+
+class ResultCache:
+    """Results of expensive per-image work, such as classification tags
+    and face encodings, keyed by a hash of the image file's bytes and the
+    version of the model which produced them, so that resubmitted photos
+    are not decoded or run through a model again.
+
+    Results are held in an in-process LRU bounded by `max_bytes` and, if
+    `path` is given, in a SQLite database which survives restarts, bounded
+    by `max_disk_bytes` of keys and values. The results least recently
+    written or read from disk are evicted from it first; hits in memory do
+    not count as uses on disk. Values are dicts of MessagePack-serializable values.
+    """
+    def __init__(self, max_bytes: int, path: Optional[str] = None, max_disk_bytes: int = 1024 * 2**20):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.nbytes = 0
+        self.disk_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = Lock()
+        self._db = None
+        # Held for SQLite reads and writes, so memory lookups never wait on the disk
+        self._db_lock = Lock()
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(results)')]
+            if len(columns) > 0 and 'used_at' not in columns:
+                # Written before results were evicted, without the columns to evict them by
+                self._db.execute('DROP TABLE results')
+            self._db.executescript(SCHEMA)
+            self.disk_bytes = self._db.execute(
+                'SELECT COALESCE(SUM(length(key) + length(value)), 0) FROM results').fetchone()[0]
+
+    def get(self, kind: str, digest: str, version: str) -> Optional[dict]:
+        key = f'{kind}:{version}:{digest}'
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                CACHE_LOOKUPS.inc(cache='results', result='memory_hit')
+                return msgpack.unpackb(value)
+        if self._db is not None:
+            with self._db_lock:
+                row = self._db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self._db.execute('UPDATE results SET used_at = ? WHERE key = ?', (time(), key))
+            if row is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._put_memory(key, row[0])
+                CACHE_LOOKUPS.inc(cache='results', result='disk_hit')
+                return msgpack.unpackb(row[0])
+        with self._lock:
+            self.misses += 1
+        CACHE_LOOKUPS.inc(cache='results', result='miss')
+        return None
+
+    def put(self, kind: str, digest: str, version: str, result: dict):
+        key = f'{kind}:{version}:{digest}'
+        value = msgpack.packb(result)
+        with self._lock:
+            self._put_memory(key, value)
+        if self._db is None or len(key) + len(value) > self.max_disk_bytes:
+            return
+        with self._db_lock:
+            old_row = self._db.execute(
+                'SELECT length(key) + length(value) FROM results WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                             (key, kind, version, value, time()))
+            self.disk_bytes += len(key) + len(value) - (old_row[0] if old_row is not None else 0)
+            self._evict_disk()
+
+    def remove_old_versions(self, versions: dict[str, str]):
+        'Delete the results of each kind written by any other version than the current one from disk'
+        if self._db is None:
+            return
+        with self._db_lock:
+            for kind, version in versions.items():
+                self._db.execute('DELETE FROM results WHERE kind = ? AND version != ?', (kind, version))
+            self.disk_bytes = self._db.execute(
+                'SELECT COALESCE(SUM(length(key) + length(value)), 0) FROM results').fetchone()[0]
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0,
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'disk_bytes': self.disk_bytes,
+            }
+
+    def _put_memory(self, key: str, value: bytes):
+        old_value = self._entries.pop(key, None)
+        if old_value is not None:
+            self.nbytes -= len(key) + len(old_value)
+        if len(key) + len(value) > self.max_bytes:
+            return
+        self._entries[key] = value
+        self.nbytes += len(key) + len(value)
+        while self.nbytes > self.max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.nbytes -= len(evicted_key) + len(evicted)
+
+    def _evict_disk(self):
+        'Delete the least recently used results until the database is within its limit'
+        while self.disk_bytes > self.max_disk_bytes:
+            rows = self._db.execute(
+                'SELECT key, length(key) + length(value) FROM results ORDER BY used_at LIMIT ?',
+                (EVICT_BATCH,)).fetchall()
+            if len(rows) == 0:
+                self.disk_bytes = 0
+                return
+            evicted = []
+            for key, size in rows:
+                if self.disk_bytes <= self.max_disk_bytes:
+                    break
+                evicted.append((key,))
+                self.disk_bytes -= size
+            self._db.executemany('DELETE FROM results WHERE key = ?', evicted)
@@ -1,16 +1,60 @@
-from fastapi import Body, FastAPI, HTTPException, Path, status
+import asyncio
+from contextlib import asynccontextmanager
+from os import environ
+from time import perf_counter
+from typing import Optional
+
+from fastapi import Body, FastAPI, HTTPException, Path, Query, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+import numpy as np
+from bson import ObjectId
+from bson.errors import InvalidId
 
-from .classify import ImageSceneClassifier
+from . import metrics
+from .batching import BatchScheduler
 from .face import (cluster_unmatched_encodings, get_face_encodings, has_face,
-                   match_face_encodings_to_people, to_person_img_ids)
-from .face_db import FaceDatabase
-from .util.image import images_to_arrays
-from .util.models import ClassifyResult, Image, PersonFaces
+                   match_face_encodings_to_people, shutdown_face_pool, to_person_img_ids)
+from .face_store import PeopleNotFound
+from .jobs import JobQueue
+from .services import Services
+from .util.image import FACE_DETECT_IMAGE_SIZE, decode_base64, image_digest, images_to_arrays
+from .util.models import ClassifyResult, FaceEncoding, Image, ImageFile, JobStatus, PersonFaces
+from .util.upload import read_identified_image_files, read_image_files
 from .docs import options
 
 
-app = FastAPI(**options)
+NDJSON_TYPE = 'application/x-ndjson'
+
+# Models and database, loaded in the background once the app starts
+services = Services()
+# Batches images from concurrent /classify requests into one model call
+classify_scheduler = BatchScheduler(
+    lambda batch: services.classifier.predict_batch(batch),
+    max_batch_size=int(environ.get('CLASSIFY_MAX_BATCH_SIZE', 32)),
+    max_wait=float(environ.get('CLASSIFY_MAX_WAIT_MS', 5)) / 1000
+)
+# Runs large face processing batches in the background
+face_jobs = JobQueue(
+    lambda user_id, images: group_faces(user_id, images),
+    workers=int(environ.get('JOB_WORKERS', 2)),
+    max_pending=int(environ.get('JOB_MAX_PENDING', 20)),
+    chunk_size=int(environ.get('JOB_CHUNK_SIZE', 50))
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Serve liveness checks while models load and warm up
+    loading = asyncio.get_running_loop().run_in_executor(None, services.load)
+    yield
+    await classify_scheduler.stop()
+    face_jobs.shutdown()
+    if not loading.done():
+        loading.cancel()
+    shutdown_face_pool()
+
+app = FastAPI(**options, lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=['*'],
@@ -19,22 +63,45 @@ app.add_middleware(
     allow_headers=['*']
 )
 
+@app.middleware('http')
+async def time_requests(request: Request, call_next):
+    if not metrics.ENABLED:
+        return await call_next(request)
+    start = perf_counter()
+    response = await call_next(request)
+    # Label by the route's template, so requests for different IDs share a series
+    route = request.scope.get('route')
+    metrics.REQUEST_SECONDS.observe(
+        perf_counter() - start, method=request.method,
+        path=route.path if route is not None else 'unmatched', status=response.status_code)
+    return response
+
 success = lambda: {'msg': 'Success'}
 
 
-# load model and category data
-classifier = ImageSceneClassifier()
-face_db = FaceDatabase(local=False, reset=True)
+@app.get('/health/live')
+def liveness():
+    return {'status': 'alive'}
+
+@app.get('/health/ready')
+def readiness():
+    """Ready once the classifier and database are loaded and warmed up"""
+    if services.ready.is_set():
+        return {'status': 'ready', 'load_time': services.load_time}
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    if services.error is not None:
+        return JSONResponse({'status': 'failed', 'error': services.error}, status_code=status_code)
+    return JSONResponse({'status': 'loading'}, status_code=status_code)
 
 @app.post('/reset')
 def delete():
-    face_db.reset()
+    services.face_db.reset()
 
 @app.post('/faces/{user_id}/process', 
           status_code=status.HTTP_201_CREATED, tags=['Face'], 
           response_description="Number of faces processed")
-def process_faces(images: list[Image] = Body(description="List of images in base 64 format and their ID"),
-                  user_id: str = Path(title="User ID of user to match group faces for")):
+async def process_faces(images: list[Image] = Body(description="List of images in base 64 format and their ID"),
+                        user_id: str = Path(title="User ID of user to match group faces for")):
     """
     Groups an array of images with faces by feature similarity. Similar faces are grouped under an abstract Person.
     Each face, if recognized: is assigned to one of the user's existing people.
@@ -42,58 +109,141 @@ def process_faces(images: list[Image] = Body(description="List of images in base
     unrecognized faces using Hierarchical Clustering to group such face enocdings
     together.
     """
+    # Decoded in the thread too, as decoding large photos would block every other request
+    return await run_in_threadpool(lambda: group_faces(user_id, decode_images(images)))
+
+def decode_images(images: list[Image]) -> list[ImageFile]:
+    return [ImageFile(img.id, decode_base64(img.data)) for img in images]
+
+@app.post('/faces/{user_id}/process/binary', 
+          status_code=status.HTTP_201_CREATED, tags=['Face'], 
+          response_description="Number of faces processed")
+async def process_faces_binary(request: Request,
+                               user_id: str = Path(title="User ID of user to match group faces for")):
+    """
+    Same as `/faces/{user_id}/process`, with images uploaded as raw bytes rather than base 64:
+    either `multipart/form-data` with a file part per image named by its ID, or an
+    `application/msgpack` array of maps with `id` and binary `data` keys.
+    """
+    images = [ImageFile(id, data) for id, data in await read_identified_image_files(request)]
+    return await run_in_threadpool(group_faces, user_id, images)
+
+@app.post('/faces/{user_id}/jobs',
+          status_code=status.HTTP_202_ACCEPTED, tags=['Face'], response_model=JobStatus,
+          response_description="The queued job, whose ID its progress is read by")
+async def submit_face_job(images: list[Image] = Body(description="List of images in base 64 format and their ID"),
+                          user_id: str = Path(title="User ID of user to match group faces for")):
+    """
+    Same as `/faces/{user_id}/process`, run in the background for large batches: the images
+    are queued and the job is returned straight away. Poll `GET /faces/{user_id}/jobs/{job_id}`
+    for its progress and result. Images are processed in chunks, each matched against the
+    people created from the chunks before it, and a user's jobs run one at a time.
+    """
+    job = await run_in_threadpool(lambda: submit_faces_job(user_id, decode_images(images)))
+    return job.to_status()
+
+@app.post('/faces/{user_id}/jobs/binary',
+          status_code=status.HTTP_202_ACCEPTED, tags=['Face'], response_model=JobStatus,
+          response_description="The queued job, whose ID its progress is read by")
+async def submit_face_job_binary(request: Request,
+                                 user_id: str = Path(title="User ID of user to match group faces for")):
+    """
+    Same as `/faces/{user_id}/jobs`, with images uploaded as raw bytes as `/faces/{user_id}/process/binary` takes them.
+    """
+    images = [ImageFile(id, data) for id, data in await read_identified_image_files(request)]
+    return (await run_in_threadpool(submit_faces_job, user_id, images)).to_status()
+
+def submit_faces_job(user_id: str, images: list[ImageFile]):
+    # Reject images which already exist now, rather than once the job reaches them
+    check_new_images(user_id, images)
+    return face_jobs.submit(user_id, images)
+
+@app.get('/faces/{user_id}/jobs/{job_id}', response_model=JobStatus, tags=['Face'])
+def get_face_job(user_id: str = Path(title="User ID the job was submitted for"),
+                 job_id: str = Path(title="ID of the job")):
+    """Progress of a face processing job: images processed and faces found so far,
+    and why it failed if it did. Images processed before a failure stay stored.
+    Finished jobs are forgotten after an hour."""
+    job = face_jobs.get(job_id)
+    if job is None or job.user_id != user_id:
+        raise HTTPException(detail=f"Job ID {job_id} not found", status_code=404)
+    return job.to_status()
+
+def check_new_images(user_id: str, images: list[ImageFile]):
     image_ids = [image.id for image in images]
-    stored_ids = face_db.get_user_image_ids(user_id)
-    existing_ids = set(image_ids).intersection(set(stored_ids))
+    existing_ids = set(services.face_db.get_existing_image_ids(user_id, image_ids))
     if len(existing_ids) != 0:
         raise HTTPException(detail=f"Images with IDs {existing_ids} already exist in database",
                             status_code=400)
 
-    people_face_encodings = face_db.get_user_face_encodings(user_id)
+def group_faces(user_id: str, images: list[ImageFile]) -> int:
+    check_new_images(user_id, images)
+
+    people_face_encodings = services.face_db.get_user_face_encodings(user_id)
     if people_face_encodings is None:
         try:
-            face_db.create_user(user_id)
+            services.face_db.create_user(user_id)
         except Exception as exception:
-            return str(exception), 500
+            raise HTTPException(status_code=500, detail=str(exception))
         else:
             people_face_encodings = dict()
 
-    num_people = len(people_face_encodings.keys())
+    faces = get_face_encodings(images, cache=services.result_cache)
+    metrics.IMAGES.inc(len(images), endpoint='faces')
+    metrics.FACES.inc(len(faces))
+    try:
+        store_matched_faces(user_id, faces, len(people_face_encodings))
+    except PeopleNotFound:
+        # People were deleted after the user's faces were read, by a concurrent request
+        # or through another worker, so the faces are matched again to the people left
+        people_face_encodings = services.face_db.get_user_face_encodings(user_id) or dict()
+        store_matched_faces(user_id, faces, len(people_face_encodings))
 
-    faces = get_face_encodings(images)
+    return len(faces) # number of faces detected
+
+def store_matched_faces(user_id: str, faces: list[FaceEncoding], num_people: int):
     unmatched_faces, updated_people_faces = match_face_encodings_to_people(
-        faces, people_face_encodings)
+        faces, services.face_db.get_user_face_index(user_id))
     if len(unmatched_faces) == 1:
         # If only one face is unmatched, assign it to a new person
-        new_people_faces = { f'Person {num_people + 1}': faces } 
+        new_people_faces = { f'Person {num_people + 1}': unmatched_faces } 
     else:
         # Otherwise use clustering to group faces by similarity
         new_people_faces = cluster_unmatched_encodings(unmatched_faces, num_people)
 
-    # For each existing person, append their newly matched face encodings in the database
-    for person, face_encodings in updated_people_faces.items():
-        face_db.insert_encodings(person.id, face_encodings)
-        # Update link from image to person
-        face_db.insert_image_person(face_encodings, user_id, person.id)
-
-    # For each new person, create a Person document, add it to the user's people array
-    # and insert the person's encodings.
-    for person_name, face_encodings in new_people_faces.items():
-        person_id = face_db.create_person(person_name)
-        face_db.add_person_to_user(user_id, person_id)
-        face_db.insert_encodings(person_id, face_encodings)
-        # Update link from image to person
-        face_db.insert_image_person(face_encodings, user_id, person_id)
-
-    return len(faces) # number of faces detected
+    # Append newly matched face encodings to existing people, create a Person document
+    # for each new person under the user, and link every image to its people
+    services.face_db.insert_matched_faces(user_id, updated_people_faces, new_people_faces)
+    metrics.PEOPLE_CREATED.inc(len(new_people_faces))
 
 @app.get('/faces/{user_id}', response_model=list[PersonFaces], tags=['Face'])
-def get_faces(user_id: str = Path(title="User ID to find person-faces mappings for")):
-    people_faces = face_db.get_user_face_encodings(user_id)
-    if people_faces is None: 
+def get_faces(request: Request,
+              response: Response,
+              user_id: str = Path(title="User ID to find person-faces mappings for"),
+              cursor: Optional[str] = Query(
+                  default=None, description="Return people after this cursor, from the previous page's X-Next-Cursor header"),
+              limit: Optional[int] = Query(default=None, ge=1, description="Maximum number of people to return"),
+              image_limit: Optional[int] = Query(
+                  default=None, ge=1, description="Maximum number of image IDs to return for each person")):
+    """People in order of creation with the IDs of the images they are in. When `limit` people
+    are returned, the `X-Next-Cursor` header holds the cursor of the next page.
+    With `Accept: application/x-ndjson`, people are streamed one per line as they are read."""
+    try:
+        after = None if cursor is None else ObjectId(cursor)
+    except InvalidId:
+        raise HTTPException(detail=f"Invalid cursor '{cursor}'", status_code=400)
+    people = services.face_db.get_user_people(user_id, after=after, limit=limit)
+    if people is None: 
         return []
-    # Remove encoding data
-    return to_person_img_ids(people_faces)
+    if limit is not None and len(people) == limit:
+        response.headers['X-Next-Cursor'] = str(people[-1].id)
+    people_images = services.face_db.iter_people_images(people, image_limit)
+
+    if NDJSON_TYPE in request.headers.get('accept', ''):
+        lines = (to_person_img_ids({person: image_ids})[0].json() + '\n'
+                 for person, image_ids in people_images)
+        return StreamingResponse(lines, media_type=NDJSON_TYPE, headers=dict(response.headers))
+    return to_person_img_ids(dict(people_images))
 
 
 @app.patch('/faces/{user_id}/{person_id}/rename', tags=['Face'])
@@ -101,7 +251,7 @@ def rename_person(name: str,
                   user_id: str = Path(
                       title="User ID of user who with Person ID as one of their known people"),
                   person_id: str = Path(title="ID of person to rename")):
-    face_db.set_person_name(user_id, person_id, name)
+    services.face_db.set_person_name(user_id, person_id, name)
     return success()
 
 
@@ -110,7 +260,7 @@ def delete_person_img(user_id: str = Path(title="ID of user who with Person ID a
                       image_id: str = Path(title="ID of image to delete")):
     """For each person whose face is in the image, delete their reference to the image.
     Returns a list of affected people IDs."""
-    affected_people = face_db.delete_user_image(user_id, image_id)
+    affected_people = services.face_db.delete_user_image(user_id, image_id)
     if affected_people == []:
         raise HTTPException(
             status_code=404, detail=f"User or Image ID not found (0 deletions)")
@@ -118,25 +268,82 @@ def delete_person_img(user_id: str = Path(title="ID of user who with Person ID a
     return [str(id) for id in affected_people]
 
 
+@app.post('/faces/{user_id}/delete', response_model=dict[str, list[str]], tags=['Face'])
+def delete_person_imgs(image_ids: list[str],
+                       user_id: str = Path(title="ID of user who with Person ID as one of their known people")):
+    """Delete a batch of images, as `DELETE /faces/{user_id}/{image_id}` does for each one,
+    in a single transaction. Returns the affected people IDs of each deleted image;
+    images which were not found are left out."""
+    affected_people = services.face_db.delete_user_images(user_id, image_ids)
+    # Convert ObjectId to string
+    return {image_id: [str(id) for id in people] for image_id, people in affected_people.items()}
+
+
 @app.post('/classify', tags=['Scene Classification'], 
           response_model=list[ClassifyResult], 
           response_description="Array of tags and whether an image has a face for each input image in order")
-def classify(images: list[str] = Body(title="List of base 64 encoded images to classify tags for")):
-    num_imgs = len(images)
+async def classify(images: list[str] = Body(title="List of base 64 encoded images to classify tags for")):
+    return await classify_images(await run_in_threadpool(lambda: [decode_base64(img) for img in images]))
+
+@app.post('/classify/binary', tags=['Scene Classification'], 
+          response_model=list[ClassifyResult], 
+          response_description="Array of tags and whether an image has a face for each input image in order")
+async def classify_binary(request: Request):
+    """
+    Same as `/classify`, with images uploaded as raw bytes rather than base 64:
+    either `multipart/form-data` with a file part per image, or an `application/msgpack` 
+    array of binary values.
+    """
+    return await classify_images(await read_image_files(request))
+
+@app.get('/classify/stats', tags=['Scene Classification'])
+def classify_stats():
+    """Queue depth and achieved batch sizes of the classifier's cross-request batching"""
+    return classify_scheduler.stats()
+
+@app.get('/metrics', response_class=PlainTextResponse)
+def get_metrics():
+    """Per-stage latency histograms and counters in the Prometheus text format"""
+    if not metrics.ENABLED:
+        raise HTTPException(detail="Metrics are disabled", status_code=404)
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+@app.get('/cache/stats')
+def cache_stats():
+    """Hit rates of the per-image result cache and the per-user face cache"""
+    return {
+        'results': services.result_cache.stats(),
+        'faces': services.face_db.cache.stats(),
+    }
+
+async def classify_images(img_bytes: list[bytes]) -> list[ClassifyResult]:
+    num_imgs = len(img_bytes)
     if num_imgs == 0:
-        return HTTPException(detail="Empty image array", status_code=400)
+        raise HTTPException(detail="Empty image array", status_code=400)
+    metrics.IMAGES.inc(num_imgs, endpoint='classify')
+
+    version = services.classify_version
+    digests = [image_digest(data) for data in img_bytes]
+    results = [services.result_cache.get('classify', digest, version) for digest in digests]
+    to_classify = [i for i, result in enumerate(results) if result is None]
 
-    # Convert images from encoded base64 to np array format with shape (160, 160)
-    img_batch = images_to_arrays(images)
+    if len(to_classify) > 0:
+        img_batch, face_flags = await run_in_threadpool(
+            prepare_images, [img_bytes[i] for i in to_classify], [digests[i] for i in to_classify])
+        predictions = await classify_scheduler.predict(img_batch)
+        image_tags = services.classifier.tags_from_predictions(predictions)
+        for i, tags, img_has_face in zip(to_classify, image_tags, face_flags):
+            results[i] = {'tags': tags, 'has_face': img_has_face}
+            services.result_cache.put('classify', digests[i], version, results[i])
 
-    # Get indexes of images with faces
-    face_idxs = has_face(img_batch)
+    return [ClassifyResult(**result) for result in results]
 
-    predictions = classifier.predict(img_batch)
-    image_tags = classifier.tags_from_predictions(predictions)
-    print(f'{image_tags=}')
+def prepare_images(img_bytes: list[bytes], digests: list[str]) -> tuple[np.ndarray, list[bool]]:
+    'Decode and resize images for the classifier, and find whether each has a face'
+    # Convert images to np arrays, only as large as needed
+    # to detect faces since the classifier downsizes them further
+    img_batch = images_to_arrays(img_bytes, FACE_DETECT_IMAGE_SIZE)
 
-    return [ClassifyResult(
-        tags=image_tags[i],
-        has_face=True if i in face_idxs else False
-    ) for i in range(num_imgs)]
+    # Whether each image has a face
+    face_flags = has_face(img_batch, digests)
+    return services.classifier.process_batch(img_batch), face_flags
@@ -0,0 +1,90 @@
+from os import environ
+from threading import Event
+from time import perf_counter
+from typing import Optional
+
+import numpy as np
+from fastapi import HTTPException
+
+from .classify import BATCH_BUCKETS, IMG_SIZE, ImageSceneClassifier
+from .face import FACE_ENCODER_VERSION, warm_face_pool
+from .face_db import FaceDatabase
+from .face_store import FaceStore
+from .local_face_db import LocalFaceDatabase
+from .result_cache import ResultCache
+from .util.image import FACE_DETECT_IMAGE_SIZE
+
+
+class Services:
+    """The classifier and face database used by the endpoints. They are
+    loaded by `load` when the app starts rather than when the server
+    module is imported, and the app only reports ready once they are
+    loaded and, optionally, warmed up.
+    """
+    def __init__(self):
+        self._classifier: Optional[ImageSceneClassifier] = None
+        self._face_db: Optional[FaceStore] = None
+        self.ready = Event()
+        self.error: Optional[str] = None
+        self.load_time: Optional[float] = None
+        # Available straight away, as it needs no models
+        self.result_cache = ResultCache(
+            max_bytes=int(environ.get('RESULT_CACHE_MB', 64)) * 2**20,
+            path=environ.get('RESULT_CACHE_PATH'),
+            max_disk_bytes=int(environ.get('RESULT_CACHE_DISK_MB', 1024)) * 2**20)
+
+    @property
+    def classifier(self) -> ImageSceneClassifier:
+        if self._classifier is None:
+            raise HTTPException(detail="Classifier is still loading", status_code=503)
+        return self._classifier
+
+    @property
+    def classify_version(self) -> str:
+        'Classification results depend on the model and the size images are decoded at'
+        return f'{self.classifier.version}-{FACE_DETECT_IMAGE_SIZE}'
+
+    @property
+    def face_db(self) -> FaceStore:
+        if self._face_db is None:
+            raise HTTPException(detail="Face database is still connecting", status_code=503)
+        return self._face_db
+
+    def inject(self, classifier: Optional[ImageSceneClassifier] = None, face_db: Optional[FaceStore] = None):
+        'Use these instead of loading the real ones when the app starts, such as stubs for load testing'
+        self._classifier = classifier
+        self._face_db = face_db
+
+    def load(self):
+        start = perf_counter()
+        try:
+            if self._face_db is None:
+                self._face_db = self.load_face_db()
+            if self._classifier is None:
+                self._classifier = ImageSceneClassifier(backend=environ.get('CLASSIFIER_BACKEND', 'keras'))
+            # Results of earlier models can never be read again
+            self.result_cache.remove_old_versions({'classify': self.classify_version, 'faces': FACE_ENCODER_VERSION})
+            if environ.get('WARMUP', '1') == '1':
+                self.warmup()
+        except Exception as err:
+            self.error = repr(err)
+            raise
+        self.load_time = perf_counter() - start
+        print(f"Services ready in {self.load_time:.1f}s")
+        self.ready.set()
+
+    @staticmethod
+    def load_face_db() -> FaceStore:
+        'MongoDB Atlas, or local files in `FACE_DB_PATH` if `FACE_DB=local`'
+        # Only drop everything when explicitly asked to
+        reset = environ.get('RESET_DB') == '1'
+        if environ.get('FACE_DB', 'mongo') == 'local':
+            return LocalFaceDatabase(environ.get('FACE_DB_PATH', 'face-db'), reset=reset)
+        return FaceDatabase(local=False, reset=reset)
+
+    def warmup(self):
+        'Run dummy batches through the classifier and dlib so the first requests are not slow'
+        # Trace the classifier for the batch sizes requests are likely to use
+        for bucket in BATCH_BUCKETS[:6]:
+            self._classifier.predict_batch(np.zeros((bucket, *IMG_SIZE, 3), dtype=np.float32))
+        warm_face_pool()
@@ -1,12 +1,43 @@
 from base64 import b64decode
+from hashlib import blake2b
 from io import BytesIO
+from math import ceil
+from typing import Optional
 
 import numpy as np
-from PIL import Image, UnidentifiedImageError
+from PIL import Image, ImageOps, UnidentifiedImageError
 from fastapi import HTTPException
 from binascii import Error as DecodeError
 
-def base64_img_to_array(img_data):
+from ..metrics import timed
+
+# Length of the shorter side images are decoded at for each use,
+# so that no caller decodes more pixels than it needs
+# Classifier input is 160x160
+CLASSIFY_IMAGE_SIZE = 160
+# Large enough to tell whether an image has a face, though
+# small faces in group photos may be missed at this size
+FACE_DETECT_IMAGE_SIZE = 480
+# Large enough to detect and encode the faces in group photos
+FACE_ENCODE_IMAGE_SIZE = 1024
+
+def downscale(img: Image.Image, size: int) -> Image.Image:
+    '''Shrink an image so its shorter side is `size`, keeping its aspect ratio.
+    Must be called before the image is loaded so that JPEGs can be decoded 
+    directly at 1/2, 1/4 or 1/8 scale instead of at full resolution.'''
+    scale = size / min(img.size)
+    if scale >= 1:
+        return img
+    target = (ceil(img.width * scale), ceil(img.height * scale))
+    # Decode at the smallest JPEG scale no smaller than the target (no-op for other formats),
+    # then resize the rest of the way
+    img.draft(None, target)
+    img.thumbnail(target, Image.BILINEAR, reducing_gap=None)
+    return img
+
+@timed('base64_decode')
+def decode_base64(img_data: str) -> bytes:
+    'Decode a base-64 image, with or without a data URL prefix, into the bytes of its file'
     try:
         img_base64 = img_data.split(",")[1]
     except AttributeError:
@@ -18,24 +49,39 @@ def base64_img_to_array(img_data):
         decoded_img = b64decode(img_base64)
     except DecodeError:
         raise HTTPException(detail=f"Entry in 'images' list is not a base64 string", status_code=500)
+    return decoded_img
+
+def image_digest(img_bytes: bytes) -> str:
+    'Hash of the bytes of an image file, identifying the same image across requests'
+    return blake2b(img_bytes, digest_size=16).hexdigest()
+
+def bytes_img_to_array(img_bytes: bytes, size: Optional[int] = None):
+    '''Decode the bytes of an image file into an RGB array, with EXIF orientation applied.
+    If `size` is given, larger images are decoded with their shorter side
+    reduced to `size` pixels.'''
     try:
-        img = Image.open(BytesIO(decoded_img))
+        img = Image.open(BytesIO(img_bytes))
     except UnidentifiedImageError:
         raise HTTPException(detail="Unsupported file extension. Use .jpg or .png", status_code=400)
+
+    if size is not None:
+        img = downscale(img, size)
+    # Phone cameras store rotation in EXIF rather than rotating the pixels
+    img = ImageOps.exif_transpose(img)
         
-    if img.mode == 'RGBA':
+    if img.mode in ('RGBA', 'CMYK'):
         img = img.convert("RGB")
-    elif img.mode == 'CMYK':
-        img = img.convert('CMYK')
-    # elif not img.mode == 'RGB':
-        raise HTTPException(detail="Unsupported color mode {img.mode}. Accepted: RGB, RGBA and CMYK", status_code=400)
     
     return np.array(img)
 
-def images_to_arrays(base64_images: list[str]):
+def base64_img_to_array(img_data, size: Optional[int] = None):
+    return bytes_img_to_array(decode_base64(img_data), size)
+
+@timed('image_decode')
+def images_to_arrays(images: list[bytes], size: Optional[int] = None):
     img_batch: list[np.ndarray] = []
-    for img_data in base64_images:
-        img_arr = base64_img_to_array(img_data)
+    for img_bytes in images:
+        img_arr = bytes_img_to_array(img_bytes, size)
 
         if len(img_arr.shape) == 2:
             raise HTTPException(detail=f"Image has a single color channel. Expected RGB.", status_code=400)
@@ -1,9 +1,9 @@
 import json
 from dataclasses import dataclass
-from typing import Union
+from typing import Optional, Union
 
 import numpy as np
-from bson import ObjectId
+from bson import Binary, ObjectId
 from pydantic import BaseModel, Field
 
 
@@ -29,6 +29,12 @@ class Image(BaseModel):
     data: str = Field(description="Image encoded in base64 format, containing at least one face")
     id: str = Field(description="(external) ID of the image")
 
+@dataclass
+class ImageFile:
+    'An image decoded from base 64, or uploaded as binary, before it is decoded into pixels'
+    id: str
+    data: bytes
+
 class ClassifyResult(BaseModel):
     tags: list[str] = Field(description="Tags assigned to the corresponding input image")
     has_face: bool = Field(description="Whether the corresponding input image has a face")
@@ -40,20 +46,53 @@ class ClassifyResult(BaseModel):
             }
         }
 
+class JobStatus(BaseModel):
+    id: str = Field(description="ID of the job")
+    status: str = Field(description="One of `queued`, `running`, `done` or `failed`")
+    images_total: int = Field(description="Number of images in the job")
+    images_done: int = Field(description="Number of images processed so far, whose faces are stored")
+    faces_found: int = Field(description="Number of faces found in the images processed so far")
+    error: Optional[str] = Field(default=None, description="Why the job failed, if it did")
+    elapsed: Optional[float] = Field(
+        default=None, description="Seconds the job has been running for, or took once finished")
+    class Config:
+        schema_extra = {
+            "example": {
+                "id": "3f2b9c1e0d8a4c6b9e7f5a1d2c3b4a59",
+                "status": "running",
+                "images_total": 500,
+                "images_done": 150,
+                "faces_found": 212,
+                "error": None,
+                "elapsed": 41.3
+            }
+        }
+
+# Encodings are stored as raw little-endian float32 bytes
+ENCODING_DTYPE = np.dtype('<f4')
+
 @dataclass
 class FaceEncoding:
     image_id: str
     encoding: np.ndarray
 
-    def to_dict(self) -> dict[str, Union[str, np.ndarray]]:
-        return {'image_id': self.image_id, 'encoding': str(list(self.encoding))}
+    def to_dict(self) -> dict[str, Union[str, Binary]]:
+        encoding = np.ascontiguousarray(self.encoding, dtype=ENCODING_DTYPE)
+        return {'image_id': self.image_id, 'encoding': Binary(encoding.tobytes())}
 
     @staticmethod
-    def from_dict(d: dict[str, str]):
+    def from_dict(d: dict[str, Union[str, bytes]]):
         assert set(d.keys()).intersection(
             {'image_id', 'encoding'}) == {'image_id', 'encoding'}
-        d['encoding'] = np.array(json.loads(d['encoding']))
-        return FaceEncoding(**d)
+        return FaceEncoding(**{**d, 'encoding': decode_encoding(d['encoding'])})
+
+
+def decode_encoding(encoding: Union[str, bytes]) -> np.ndarray:
+    '''Decode a stored encoding without copying its bytes. Encodings 
+    stored before the switch to binary are stringified lists.'''
+    if isinstance(encoding, str):
+        return np.array(json.loads(encoding), dtype=ENCODING_DTYPE)
+    return np.frombuffer(encoding, dtype=ENCODING_DTYPE)
 
 
 @dataclass
@@ -62,7 +101,7 @@ class Person:
     name: str
 
     def __hash__(self):
-        return hash(id)
+        return hash(self.id)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+import msgpack
+from fastapi import HTTPException, Request
+from starlette.datastructures import UploadFile
+
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+MULTIPART_TYPE = 'multipart/form-data'
+# Largest MessagePack body accepted
+MAX_MSGPACK_BYTES = 512 * 2**20
+
+
+async def read_msgpack(request: Request):
+    '''Unpack a MessagePack request body as it is received, without
+    first collecting the whole body into one bytes object.'''
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=MAX_MSGPACK_BYTES)
+    try:
+        async for chunk in request.stream():
+            unpacker.feed(chunk)
+        return unpacker.unpack()
+    except msgpack.BufferFull:
+        raise HTTPException(detail=f"MessagePack body larger than {MAX_MSGPACK_BYTES} bytes", status_code=413)
+    except (msgpack.OutOfData, msgpack.ExtraData, ValueError):
+        raise HTTPException(detail="Body is not valid MessagePack", status_code=400)
+
+
+async def read_multipart(request: Request) -> list[tuple[str, bytes]]:
+    'Read every file part of a multipart form as (field name, file bytes) pairs, in order'
+    form = await request.form()
+    try:
+        return [(name, await part.read())
+                for name, part in form.multi_items() if isinstance(part, UploadFile)]
+    finally:
+        await form.close()
+
+
+def content_type(request: Request) -> str:
+    return request.headers.get('content-type', '').split(';')[0].strip().lower()
+
+
+def unsupported_media_type(request: Request) -> HTTPException:
+    return HTTPException(
+        detail=f"Unsupported content type '{content_type(request)}'. "
+               f"Use {MULTIPART_TYPE} or {MSGPACK_TYPES[0]}",
+        status_code=415)
+
+
+async def read_image_files(request: Request) -> list[bytes]:
+    '''Read images uploaded as raw bytes, either as the file parts of a
+    multipart form or as a MessagePack array of binary values.'''
+    if content_type(request) == MULTIPART_TYPE:
+        return [data for _, data in await read_multipart(request)]
+    if content_type(request) in MSGPACK_TYPES:
+        images = await read_msgpack(request)
+        if not isinstance(images, list) or not all(isinstance(img, bytes) for img in images):
+            raise HTTPException(detail="Bad format: body must be an array of binary images", status_code=400)
+        return images
+    raise unsupported_media_type(request)
+
+
+async def read_identified_image_files(request: Request) -> list[tuple[str, bytes]]:
+    '''Read images uploaded as raw bytes with their IDs, either as the file parts
+    of a multipart form named by image ID, or as a MessagePack array of
+    maps with `id` and binary `data` keys.'''
+    if content_type(request) == MULTIPART_TYPE:
+        return await read_multipart(request)
+    if content_type(request) in MSGPACK_TYPES:
+        images = await read_msgpack(request)
+        if not isinstance(images, list) or not all(
+                isinstance(img, dict) and isinstance(img.get('id'), str) and isinstance(img.get('data'), bytes)
+                for img in images):
+            raise HTTPException(
+                detail="Bad format: body must be an array of maps with 'id' and binary 'data'", status_code=400)
+        return [(img['id'], img['data']) for img in images]
+    raise unsupported_media_type(request)
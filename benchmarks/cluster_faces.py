@@ -0,0 +1,68 @@
+"""Compares clustering every unmatched face at once against grouping
+them first, as `cluster_unmatched_encodings` does for large uploads,
+over a range of upload sizes.
+
+Agreement is the adjusted Rand index of each clustering with the true
+people, and of the grouped clustering with clustering all faces at once.
+
+Usage: 'python -m benchmarks.cluster_faces'
+"""
+import time
+
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+
+from api.face import agglomerative_labels, grouped_cluster_labels
+
+# Number of unmatched faces in each simulated upload
+UPLOAD_SIZES = [500, 1000, 2000, 4000, 8000]
+# Clustering every face at once is skipped above this size
+MAX_EXACT_SIZE = 8000
+# Larger uploads are only clustered in groups
+GROUPED_ONLY_SIZES = [20_000]
+FACES_PER_PERSON = 10
+# Spread of people's faces in encoding space; the smaller spread
+# puts many people within the clustering threshold of each other
+PEOPLE_SPREADS = [0.1, 0.04]
+
+
+def synthetic_upload(num_faces: int, spread: float, rng: np.random.Generator):
+    """Faces of random people, each a random point in encoding space with
+    their encodings scattered closely around it, like real FaceNet encodings."""
+    people = rng.integers(0, max(1, num_faces // FACES_PER_PERSON), num_faces)
+    centres = rng.normal(0, spread, (people.max() + 1, 128))
+    encodings = centres[people] + rng.normal(0, 0.015, (num_faces, 128))
+    return encodings.astype(np.float32), people
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark(spread: float, num_faces: int, rng: np.random.Generator):
+    samples, people = synthetic_upload(num_faces, spread, rng)
+    grouped, grouped_time = timed(grouped_cluster_labels, samples)
+    if num_faces <= MAX_EXACT_SIZE:
+        exact, exact_time = timed(agglomerative_labels, samples)
+        print(f"{spread:>6} {num_faces:>7} {exact_time:>10.2f} {grouped_time:>11.2f} "
+              f"{adjusted_rand_score(people, exact):>10.3f} "
+              f"{adjusted_rand_score(people, grouped):>11.3f} "
+              f"{adjusted_rand_score(exact, grouped):>10.3f}")
+    else:
+        print(f"{spread:>6} {num_faces:>7} {'-':>10} {grouped_time:>11.2f} {'-':>10} "
+              f"{adjusted_rand_score(people, grouped):>11.3f} {'-':>10}")
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'spread':>6} {'faces':>7} {'exact (s)':>10} {'grouped (s)':>11} {'exact ARI':>10} "
+          f"{'grouped ARI':>11} {'agreement':>10}")
+    for spread in PEOPLE_SPREADS:
+        for num_faces in UPLOAD_SIZES + GROUPED_ONLY_SIZES:
+            benchmark(spread, num_faces, rng)
+
+
+if __name__ == '__main__':
+    main()
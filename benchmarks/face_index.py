@@ -0,0 +1,70 @@
+"""Compares matching faces with a `FaceIndex` against exact search over a
+`FaceMatrix`, over a range of user sizes and limits on the partitions
+probed per face.
+
+Recall is the fraction of (face, person) matches found by exact search
+which the index also finds. Scanned is the fraction of the user's
+encodings each face was compared with.
+
+Usage: 'python -m benchmarks.face_index'
+"""
+import time
+
+import numpy as np
+
+from api.face import TOLERANCE, FaceMatrix
+from api.face_index import FaceIndex
+from benchmarks.match_faces import synthetic_batch, synthetic_user
+
+# (number of people, encodings per person) for each simulated user
+USER_SIZES = [(250, 20), (1000, 20), (2500, 20), (1000, 50)]
+# Limits on the partitions probed per face, None only prunes by the triangle inequality
+MAX_PROBES = [None, 16, 4, 1]
+REPEATS = 3
+
+
+def best_time(fn, *args) -> float:
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def check_updates(people, batch):
+    'An index updated in place must match the same faces as one built from scratch'
+    person, faces = next(iter(people.items()))
+    index = FaceIndex(people)
+    index.set_person(person, faces[len(faces) // 2:] + batch)
+    updated = {**people, person: faces[len(faces) // 2:] + batch}
+    faces = np.array([face.encoding for face in batch])
+    assert (index.matches(faces) == FaceMatrix.from_people(updated).matches(faces)).all()
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'people':>7} {'enc/person':>10} {'probes':>7} {'exact (s)':>10} "
+          f"{'index (s)':>10} {'speedup':>8} {'scanned':>8} {'recall':>7}")
+    for num_people, faces_per_person in USER_SIZES:
+        people, centres = synthetic_user(num_people, faces_per_person, rng)
+        batch = synthetic_batch(centres, rng)
+        faces = np.array([face.encoding for face in batch])
+        check_updates(people, batch)
+
+        matrix = FaceMatrix.from_people(people)
+        expected = matrix.matches(faces, TOLERANCE)
+        exact_time = best_time(matrix.matches, faces, TOLERANCE)
+        for max_probes in MAX_PROBES:
+            index = FaceIndex(people, max_probes=max_probes)
+            actual = index.matches(faces, TOLERANCE)
+            recall = (actual & expected).sum() / max(1, expected.sum())
+            scanned = index.last_scanned / (len(faces) * len(index))
+            index_time = best_time(index.matches, faces, TOLERANCE)
+            print(f"{num_people:>7} {faces_per_person:>10} {str(max_probes or '-'):>7} "
+                  f"{exact_time:>10.4f} {index_time:>10.4f} {exact_time / index_time:>7.1f}x "
+                  f"{scanned:>8.1%} {recall:>7.3f}")
+
+
+if __name__ == '__main__':
+    main()
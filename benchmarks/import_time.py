@@ -0,0 +1,36 @@
+"""Measures how long importing the server takes in a fresh interpreter,
+and which modules take longest to import, to catch startup regressions.
+Models and the database are loaded after import, when the app starts.
+
+Usage: 'python -m benchmarks.import_time [module]'
+"""
+import subprocess
+import sys
+
+NUM_SLOWEST = 15
+
+
+def main():
+    module = sys.argv[1] if len(sys.argv) > 1 else 'api.server'
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True)
+
+    # Lines look like 'import time:  self [us] | cumulative | imported package'
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        timings.append((int(cumulative), name.rstrip()))
+
+    # Only top-level imports are unindented, so the module's own entry is the total
+    total = next(us for us, name in timings if name.strip() == module)
+    print(f"Importing {module} took {total / 1e6:.3f}s")
+    print(f"Slowest imports (cumulative):")
+    for us, name in sorted(timings, reverse=True)[:NUM_SLOWEST]:
+        print(f"{us / 1e6:>8.3f}s {name}")
+
+
+if __name__ == '__main__':
+    main()
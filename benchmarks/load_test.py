@@ -0,0 +1,306 @@
+"""Load test of the whole app, with no MongoDB, GPU or models: the scene
+classifier is replaced by a stub returning random probabilities, dlib by
+a stub face encoder and the database by an in-process mongomock client.
+Everything else, from request parsing and image decoding to matching,
+clustering and database queries, is the real code.
+
+Concurrent clients send a mix of `/classify`, `/faces/{user_id}/process`,
+`GET /faces/{user_id}` and single and batch deletes, and the latency
+percentiles and throughput of each are reported, along with the time
+spent in each stage from `/metrics`. Since the models take no time,
+this measures the framework, serialization and database overheads.
+Database stages time mongomock's queries, which are much slower than
+MongoDB's, so compare them between runs rather than with production.
+Set `FACE_DB=local` to load test `LocalFaceDatabase` in a new temporary
+directory instead.
+
+The stub encoder gives each face the encoding of an identity chosen by
+the image's colour, plus a little noise, so faces of the same identity
+are matched to the same person.
+
+By default requests are sent to the app in process. To include the HTTP
+server, serve the stubbed app with 'uvicorn benchmarks.load_test:app'
+and pass its `--url`.
+
+Usage: 'python -m benchmarks.load_test [--duration 20] [--concurrency 16] [--users 20]
+                                       [--mix classify=4,process=2,list=3,delete=1,delete_batch=1]
+                                       [--url URL] [--output PATH]'
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+from contextlib import nullcontext
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# Stubs must be in place before the app is imported. The stub encoder is
+# only installed in this process, so faces are encoded in it too
+os.environ['FACE_WORKERS'] = '1'
+
+NUM_IDENTITIES = 64
+# Identity colours, spaced far enough apart to survive JPEG compression
+LEVELS = (32, 96, 160, 224)
+PALETTE = np.array([(r, g, b) for r in LEVELS for g in LEVELS for b in LEVELS], dtype=np.float32)
+IDENTITY_CENTRES = np.random.default_rng(0).normal(0, 0.1, (NUM_IDENTITIES, 128))
+IMAGE_SIZE = 96
+
+
+def stub_face_locations(img: np.ndarray, number_of_times_to_upsample: int = 1, model: str = 'hog'):
+    'One face filling the image'
+    height, width = img.shape[:2]
+    return [(0, width, height, 0)]
+
+
+def stub_face_encodings(img: np.ndarray, known_face_locations=None, num_jitters: int = 1, model: str = 'small'):
+    'The encoding of the identity with the closest colour, with noise which is the same for the same image'
+    if known_face_locations is None:
+        known_face_locations = stub_face_locations(img)
+    identity = int(np.linalg.norm(PALETTE - img.reshape(-1, 3).mean(axis=0), axis=1).argmin())
+    seed = int.from_bytes(hashlib.blake2b(img.tobytes(), digest_size=8).digest(), 'little')
+    noise = np.random.default_rng(seed).normal(0, 0.015, (len(known_face_locations), 128))
+    return list(IDENTITY_CENTRES[identity] + noise)
+
+
+face_recognition = types.ModuleType('face_recognition')
+face_recognition.face_locations = stub_face_locations
+face_recognition.face_encodings = stub_face_encodings
+sys.modules['face_recognition'] = face_recognition
+
+import httpx
+import mongomock
+
+from api import server
+from api.classify import ImageSceneClassifier
+from api.face_db import FaceDatabase
+from api.local_face_db import LocalFaceDatabase
+from benchmarks.suite import StubBackend
+
+# Relative frequency of each kind of request
+DEFAULT_MIX = {'classify': 4, 'process': 2, 'list': 3, 'delete': 1, 'delete_batch': 1}
+PERCENTILES = (50, 95, 99)
+
+
+class SessionlessClient(mongomock.MongoClient):
+    '''mongomock has no sessions, so writes run outside of one, as they do
+    with a local database, which cannot run transactions'''
+    def start_session(self, **kwargs):
+        return nullcontext()
+
+
+def stub_services():
+    with open('dataset/categories.json') as f:
+        num_categories = len(json.load(f))
+    if os.environ.get('FACE_DB') == 'local':
+        face_db = LocalFaceDatabase(tempfile.mkdtemp(prefix='load-test-'))
+    else:
+        face_db = FaceDatabase(local=True, reset=True, client=SessionlessClient())
+    server.services.inject(classifier=ImageSceneClassifier(backend=StubBackend(num_categories)), face_db=face_db)
+
+
+stub_services()
+app = server.app
+
+
+def synthetic_images(count: int, rng: np.random.Generator) -> list[str]:
+    'Base 64 JPEGs, each the colour of a random identity with noise so that no two are the same'
+    images = []
+    for identity in rng.integers(0, NUM_IDENTITIES, count):
+        img = PALETTE[identity] + rng.normal(0, 6, (IMAGE_SIZE, IMAGE_SIZE, 3))
+        buffer = BytesIO()
+        Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(buffer, 'JPEG', quality=90)
+        images.append(base64.b64encode(buffer.getvalue()).decode())
+    return images
+
+
+def stage_totals(metrics_text: str) -> dict[str, list[float]]:
+    'Total seconds and count of each stage, from the Prometheus text of `/metrics`'
+    totals = defaultdict(lambda: [0.0, 0])
+    for line in metrics_text.splitlines():
+        for suffix, i in (('_sum', 0), ('_count', 1)):
+            prefix = f'photo_api_stage_seconds{suffix}{{stage="'
+            if line.startswith(prefix):
+                stage, value = line[len(prefix):].split('"} ')
+                totals[stage][i] += float(value)
+    return totals
+
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, args: argparse.Namespace):
+        self.client = client
+        self.args = args
+        self.rng = random.Random(0)
+        self.images = synthetic_images(args.images, np.random.default_rng(0))
+        self.next_image = 0
+        self.next_image_id = 0
+        self.users = [f'load-test-{i}' for i in range(args.users)]
+        # Image IDs processed for each user, which can be deleted
+        self.user_images: dict[str, list[str]] = {user: [] for user in self.users}
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.first_errors: dict[str, str] = dict()
+
+    def take_images(self, count: int) -> list[str]:
+        'Images from the pool in turn, repeats of which hit the result cache like resubmitted photos'
+        images = [self.images[(self.next_image + i) % len(self.images)] for i in range(count)]
+        self.next_image += count
+        return images
+
+    async def send(self, op: str, method: str, url: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        self.latencies[op].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            self.errors[op] += 1
+            self.first_errors.setdefault(op, f'{response.status_code} {response.text[:200]}')
+        return response
+
+    async def process(self, user: str):
+        images = []
+        for data in self.take_images(self.args.batch):
+            images.append({'id': f'img-{self.next_image_id}', 'data': data})
+            self.next_image_id += 1
+        response = await self.send('process', 'POST', f'/faces/{user}/process', json=images)
+        if response.status_code < 400:
+            self.user_images[user].extend(image['id'] for image in images)
+
+    async def request(self, op: str):
+        if op == 'classify':
+            await self.send(op, 'POST', '/classify', json=self.take_images(self.args.batch))
+        elif op == 'process':
+            await self.process(self.rng.choice(self.users))
+        elif op == 'list':
+            await self.send(op, 'GET', f'/faces/{self.rng.choice(self.users)}',
+                            params={'limit': 50, 'image_limit': 20})
+        else:
+            # Only delete images which have been processed, otherwise every delete would be a 404
+            user = self.rng.choice([user for user in self.users if len(self.user_images[user]) > 0])
+            if op == 'delete':
+                await self.send(op, 'DELETE', f'/faces/{user}/{self.pop_images(user, 1)[0]}')
+            else:
+                await self.send(op, 'POST', f'/faces/{user}/delete', json=self.pop_images(user, self.args.batch))
+
+    def pop_images(self, user: str, count: int) -> list[str]:
+        'Random processed images of a user, which are not chosen again'
+        images = self.user_images[user]
+        self.rng.shuffle(images)
+        taken, images[:] = images[:count], images[count:]
+        return taken
+
+    def choose(self, mix: dict[str, float]) -> str:
+        ops = list(mix)
+        if all(len(images) == 0 for images in self.user_images.values()):
+            ops = [op for op in ops if not op.startswith('delete')]
+        return self.rng.choices(ops, weights=[mix[op] for op in ops])[0]
+
+    async def seed(self):
+        'Give every user people and images before timing starts'
+        for _ in range(self.args.seed):
+            await asyncio.gather(*[self.process(user) for user in self.users])
+        self.latencies.clear()
+        self.errors.clear()
+
+    async def run(self, mix: dict[str, float]) -> float:
+        'Send requests from `concurrency` clients for `duration` seconds, returning the time taken'
+        start = time.perf_counter()
+        deadline = start + self.args.duration
+
+        async def client():
+            while time.perf_counter() < deadline:
+                await self.request(self.choose(mix))
+
+        await asyncio.gather(*[client() for _ in range(self.args.concurrency)])
+        return time.perf_counter() - start
+
+    def report(self, elapsed: float) -> dict:
+        ops = {op: latencies for op, latencies in self.latencies.items()}
+        ops['total'] = [latency for latencies in self.latencies.values() for latency in latencies]
+        results = dict()
+        print(f"{'request':<14} {'count':>7} {'errors':>7} {'req/s':>8} "
+              + ' '.join(f"{f'p{p} (ms)':>9}" for p in PERCENTILES))
+        for op, latencies in ops.items():
+            errors = sum(self.errors.values()) if op == 'total' else self.errors[op]
+            percentiles = np.percentile(latencies, PERCENTILES) if len(latencies) > 0 else [np.nan] * 3
+            results[op] = {'count': len(latencies), 'errors': errors, 'rps': len(latencies) / elapsed,
+                           **{f'p{p}': float(value) for p, value in zip(PERCENTILES, percentiles)}}
+            print(f"{op:<14} {len(latencies):>7} {errors:>7} {len(latencies) / elapsed:>8.1f} "
+                  + ' '.join(f'{value * 1e3:>9.1f}' for value in percentiles))
+        for op, error in self.first_errors.items():
+            print(f"First {op} error: {error}")
+        return results
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = dict()
+    for pair in text.split(','):
+        op, weight = pair.split('=')
+        if op not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Unknown request '{op}', expected one of {list(DEFAULT_MIX)}")
+        mix[op] = float(weight)
+    return mix
+
+
+async def load_test(args: argparse.Namespace):
+    if args.url is not None:
+        client = httpx.AsyncClient(base_url=args.url, timeout=None)
+        lifespan = nullcontext()
+    else:
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://app', timeout=None)
+        lifespan = server.lifespan(app)
+    async with lifespan, client:
+        if args.url is None:
+            await asyncio.to_thread(server.services.ready.wait)
+        test = LoadTest(client, args)
+        start = time.perf_counter()
+        await test.seed()
+        print(f"Seeded {args.users} users with {args.seed * args.batch} images each "
+              f"in {time.perf_counter() - start:.1f}s\n")
+
+        stages_before = stage_totals((await client.get('/metrics')).text)
+        elapsed = await test.run(args.mix)
+        stages_after = stage_totals((await client.get('/metrics')).text)
+        results = test.report(elapsed)
+
+    stages = dict()
+    print(f"\n{'stage':<28} {'calls':>7} {'total (s)':>10} {'mean (ms)':>10}")
+    for stage, (total, count) in sorted(stages_after.items(), key=lambda item: -item[1][0]):
+        total -= stages_before.get(stage, (0, 0))[0]
+        count -= stages_before.get(stage, (0, 0))[1]
+        if count > 0:
+            stages[stage] = {'calls': count, 'seconds': total}
+            print(f"{stage:<28} {count:>7.0f} {total:>10.2f} {total / count * 1e3:>10.2f}")
+    return {'elapsed': elapsed, 'concurrency': args.concurrency, 'requests': results, 'stages': stages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--duration', type=float, default=20, help="Seconds to send requests for")
+    parser.add_argument('--concurrency', type=int, default=16, help="Number of clients sending requests at once")
+    parser.add_argument('--users', type=int, default=20, help="Number of users to spread face requests over")
+    parser.add_argument('--batch', type=int, default=8, help="Images in each classify, process and batch delete request")
+    parser.add_argument('--seed', type=int, default=4, help="Process requests per user before timing starts")
+    parser.add_argument('--images', type=int, default=2000, help="Number of distinct synthetic images to send")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help="Relative frequency of each request, as op=weight pairs")
+    parser.add_argument('--url', help="Send requests to this server rather than the app in process")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = asyncio.run(load_test(args))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Compares `match_face_encodings_to_people` against the per-person,
+per-face loop it replaced, over a range of user sizes.
+
+Usage: 'python -m benchmarks.match_faces'
+"""
+import time
+from collections import defaultdict
+
+import numpy as np
+from bson import ObjectId
+
+from api.face import TOLERANCE, FaceMatrix, match_face_encodings_to_people
+from api.util.models import FaceEncoding, Person
+
+# (number of people, encodings per person) for each simulated user
+USER_SIZES = [(10, 5), (100, 10), (300, 20), (1000, 20), (1000, 50)]
+# Number of new faces in each upload batch
+BATCH_SIZE = 200
+REPEATS = 3
+
+
+def synthetic_user(num_people: int, faces_per_person: int, rng: np.random.Generator):
+    """Each person is a random point in encoding space with their
+    encodings scattered closely around it, like real FaceNet encodings."""
+    centres = rng.normal(0, 0.1, (num_people, 128))
+    people = {}
+    for i, centre in enumerate(centres):
+        encodings = centre + rng.normal(0, 0.015, (faces_per_person, 128))
+        people[Person(ObjectId(), f'Person {i + 1}')] = [
+            FaceEncoding(image_id=f'{i}-{j}', encoding=enc) for j, enc in enumerate(encodings)]
+    return people, centres
+
+
+def synthetic_batch(centres: np.ndarray, rng: np.random.Generator) -> list[FaceEncoding]:
+    # Half the batch are known people, the other half strangers
+    known = centres[rng.integers(0, len(centres), BATCH_SIZE // 2)]
+    unknown = rng.normal(0, 0.1, (BATCH_SIZE - len(known), 128))
+    encodings = np.concatenate([known, unknown]) + rng.normal(0, 0.015, (BATCH_SIZE, 128))
+    return [FaceEncoding(image_id=f'new-{i}', encoding=enc) for i, enc in enumerate(encodings)]
+
+
+def loop_match(face_encodings: list[FaceEncoding], people: dict[Person, list[FaceEncoding]]):
+    """One `compare_faces` call for every (person, face) pair."""
+    matched = [False] * len(face_encodings)
+    new_people_faces = defaultdict(list)
+    for person, person_faces in people.items():
+        for i, face in enumerate(face_encodings):
+            person_encodings = np.array([face.encoding for face in person_faces])
+            if np.any(np.linalg.norm(person_encodings - face.encoding, axis=1) <= TOLERANCE):
+                new_people_faces[person].append(face)
+                matched[i] = True
+    unmatched = [face for face, is_matched in zip(face_encodings, matched) if not is_matched]
+    return unmatched, new_people_faces
+
+
+def best_time(fn, *args) -> float:
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'people':>7} {'enc/person':>10} {'loop (s)':>10} {'matrix (s)':>10} {'speedup':>8}")
+    for num_people, faces_per_person in USER_SIZES:
+        people, centres = synthetic_user(num_people, faces_per_person, rng)
+        batch = synthetic_batch(centres, rng)
+
+        # Both implementations must agree before timing them
+        expected = loop_match(batch, people)
+        actual = match_face_encodings_to_people(batch, people)
+        assert [f.image_id for f in expected[0]] == [f.image_id for f in actual[0]]
+        assert {p: [f.image_id for f in fs] for p, fs in expected[1].items()} == \
+            {p: [f.image_id for f in fs] for p, fs in actual[1].items()}
+
+        loop_time = best_time(loop_match, batch, people)
+        # Include stacking the matrix, which is paid on every request without a cache
+        matrix_time = best_time(
+            lambda: match_face_encodings_to_people(batch, FaceMatrix.from_people(people)))
+        print(f"{num_people:>7} {faces_per_person:>10} {loop_time:>10.3f} "
+              f"{matrix_time:>10.4f} {loop_time / matrix_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Micro-benchmarks of the face and classification hot paths, run offline
+on synthetic inputs: face matching and clustering over a grid of sizes,
+encoding serialization, image decoding at several megapixel sizes and
+classifier preprocessing and tag selection with a stub model.
+
+Results are saved as JSON and compared against a baseline, so a change
+to api/face.py or api/classify.py can be judged before it is deployed.
+Timings are only comparable between runs on the same machine.
+
+Usage: 'python -m benchmarks.suite [--quick] [--filter NAME] [--output PATH]
+                                   [--baseline PATH] [--save-baseline] [--threshold 0.1]'
+"""
+import argparse
+import base64
+import json
+import platform
+import statistics
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from api.classify import ImageSceneClassifier
+from api.face import cluster_unmatched_encodings, match_face_encodings_to_people
+from api.util.image import FACE_DETECT_IMAGE_SIZE, base64_img_to_array
+from api.util.models import FaceEncoding
+from benchmarks.cluster_faces import synthetic_upload
+from benchmarks.match_faces import synthetic_batch, synthetic_user
+
+BASELINE_PATH = Path(__file__).parent / 'baseline.json'
+# Each case is timed for at least this long, and at least MIN_REPEATS times
+MIN_TIME = 0.5
+MIN_REPEATS = 3
+
+# (number of people, encodings per person) for matching
+MATCH_GRID = [(10, 5), (100, 20), (1000, 20)]
+# Number of unmatched faces to cluster
+CLUSTER_SIZES = [100, 500, 2000, 5000]
+NUM_SERIALIZED = 1000
+# Megapixels of the synthetic JPEGs, and the sizes they are decoded at
+IMAGE_MEGAPIXELS = [1, 4, 12]
+DECODE_SIZES = [None, FACE_DETECT_IMAGE_SIZE]
+CLASSIFY_BATCH_SIZES = [1, 16, 64]
+TAG_ROWS = [64, 1024]
+
+
+class StubBackend:
+    'Stands in for the scene classifier model, returning random probabilities'
+    def __init__(self, num_categories: int):
+        self.num_categories = num_categories
+        self.rng = np.random.default_rng(0)
+
+    def predict_bucket(self, batch: np.ndarray) -> np.ndarray:
+        logits = self.rng.normal(0, 2, (len(batch), self.num_categories))
+        probs = np.exp(logits)
+        return (probs / probs.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def synthetic_jpeg(megapixels: float, rng: np.random.Generator) -> bytes:
+    'A 4:3 photo-like JPEG: smooth gradients with noise, which compresses like a real photo'
+    width = int(np.sqrt(megapixels * 1e6 * 4 / 3))
+    height = width * 3 // 4
+    y, x = np.mgrid[0:height, 0:width]
+    img = np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=-1)
+    img += rng.normal(0, 12, img.shape)
+    buffer = BytesIO()
+    Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def cases(quick: bool):
+    'Yield (name, function) pairs, with inputs built ahead of timing'
+    rng = np.random.default_rng(0)
+    grid = lambda sizes: sizes[:-1] if quick else sizes
+
+    for num_people, faces_per_person in grid(MATCH_GRID):
+        people, centres = synthetic_user(num_people, faces_per_person, rng)
+        batch = synthetic_batch(centres, rng)
+        yield f'match/{num_people}x{faces_per_person}', lambda people=people, batch=batch: \
+            match_face_encodings_to_people(batch, people)
+
+    for num_faces in grid(CLUSTER_SIZES):
+        samples, _ = synthetic_upload(num_faces, 0.1, rng)
+        faces = [FaceEncoding(str(i), encoding) for i, encoding in enumerate(samples)]
+        yield f'cluster/{num_faces}', lambda faces=faces: cluster_unmatched_encodings(faces, 0)
+
+    faces = [FaceEncoding(str(i), encoding) for i, encoding in
+             enumerate(rng.normal(0, 0.1, (NUM_SERIALIZED, 128)).astype(np.float32))]
+    yield f'encoding/to_dict/{NUM_SERIALIZED}', lambda: [face.to_dict() for face in faces]
+    face_dicts = [face.to_dict() for face in faces]
+    yield f'encoding/from_dict/{NUM_SERIALIZED}', lambda: [FaceEncoding.from_dict(d) for d in face_dicts]
+
+    for megapixels in grid(IMAGE_MEGAPIXELS):
+        img_data = base64.b64encode(synthetic_jpeg(megapixels, rng)).decode()
+        for size in DECODE_SIZES:
+            yield f'decode/{megapixels}mp/{size or "full"}', lambda img_data=img_data, size=size: \
+                base64_img_to_array(img_data, size)
+
+    with open('dataset/categories.json') as f:
+        num_categories = len(json.load(f))
+    classifier = ImageSceneClassifier(backend=StubBackend(num_categories))
+    img = base64_img_to_array(base64.b64encode(synthetic_jpeg(4, rng)).decode(), FACE_DETECT_IMAGE_SIZE)
+    for batch_size in grid(CLASSIFY_BATCH_SIZES):
+        imgs = [img] * batch_size
+        yield f'classify/preprocess/{batch_size}', lambda imgs=imgs: classifier.process_batch(imgs)
+        yield f'classify/predict/{batch_size}', lambda imgs=imgs: classifier.predict(imgs)
+    for num_rows in grid(TAG_ROWS):
+        predictions = StubBackend(num_categories).predict_bucket(np.empty((num_rows, 0)))
+        yield f'classify/tags/{num_rows}', lambda predictions=predictions: \
+            classifier.tags_from_predictions(predictions)
+
+
+def measure(fn) -> dict[str, float]:
+    'Seconds per call, over repeats adding up to at least MIN_TIME'
+    fn()  # Warm up caches and lazy imports
+    times = []
+    while len(times) < MIN_REPEATS or sum(times) < MIN_TIME:
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'repeats': len(times)}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    'Print each case against the baseline, returning the names of cases slower by more than `threshold`'
+    regressions = []
+    print(f"\n{'case':<32} {'baseline (ms)':>14} {'now (ms)':>10} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<32} {'-':>14} {result['min'] * 1e3:>10.3f} {'new':>8}")
+            continue
+        # The fastest run is the least affected by other load on the machine
+        change = result['min'] / baseline[name]['min'] - 1
+        flag = ''
+        if change > threshold:
+            flag = ' slower'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = ' faster'
+        print(f"{name:<32} {baseline[name]['min'] * 1e3:>14.3f} "
+              f"{result['min'] * 1e3:>10.3f} {change:>+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--quick', action='store_true', help="Skip the largest size of every grid")
+    parser.add_argument('--filter', default='', help="Only run cases whose name contains this")
+    parser.add_argument('--output', type=Path, help="Write the results to this JSON file")
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH, help="Baseline JSON to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="Write the results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Fractional slowdown of the fastest run reported as a regression")
+    args = parser.parse_args()
+
+    results = dict()
+    print(f"{'case':<32} {'median (ms)':>12} {'min (ms)':>10} {'repeats':>8}")
+    for name, fn in cases(args.quick):
+        if args.filter not in name:
+            continue
+        results[name] = measure(fn)
+        print(f"{name:<32} {results[name]['median'] * 1e3:>12.3f} "
+              f"{results[name]['min'] * 1e3:>10.3f} {results[name]['repeats']:>8}")
+
+    report = {
+        'machine': {'python': platform.python_version(), 'numpy': np.__version__,
+                    'platform': platform.platform(), 'processor': platform.processor()},
+        'results': results,
+    }
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2))
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f"\nSaved baseline to {args.baseline}")
+    elif args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+        regressions = compare(results, baseline['results'], args.threshold)
+        if len(regressions) > 0:
+            print(f"\n{len(regressions)} cases slower than the baseline by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+# Input pipeline for training the scene classifier. Images are decoded and
+# resized on parallel calls, or read already resized from TFRecord shards
+# written once by `py train.py preprocess`, and batches are prefetched so
+# the model does not wait for its input.
+
+AUTOTUNE = tf.data.AUTOTUNE
+image_extensions = ('.bmp', '.gif', '.jpeg', '.jpg', '.png')
+records_dir = "./dataset/records/"
+# Decoded images shuffled at once when the order of the files cannot be shuffled
+shuffle_buffer = 1024
+
+record_features = {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.int64),
+}
+
+
+def split_images(training_dir: str, validation_split: float, seed: int):
+    """Class names and the image paths and label indices of the training and
+    validation subsets. Classes are the subdirectories in alphabetical order,
+    as with `image_dataset_from_directory`, and the split is fixed by `seed`."""
+    class_names = sorted(name for name in os.listdir(training_dir)
+                         if os.path.isdir(os.path.join(training_dir, name)))
+    paths, labels = [], []
+    for label, class_name in enumerate(class_names):
+        class_dir = os.path.join(training_dir, class_name)
+        for filename in sorted(os.listdir(class_dir)):
+            if filename.lower().endswith(image_extensions):
+                paths.append(os.path.join(class_dir, filename))
+                labels.append(label)
+
+    order = np.random.default_rng(seed).permutation(len(paths))
+    num_training = len(paths) - int(validation_split * len(paths))
+    subsets = {'training': order[:num_training], 'validation': order[num_training:]}
+    return class_names, {
+        subset: ([paths[i] for i in idxs], [labels[i] for i in idxs]) for subset, idxs in subsets.items()
+    }
+
+
+def decode_image(path: tf.Tensor, img_size: tuple[int, int]) -> tf.Tensor:
+    img = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    # Crop to the model's aspect ratio and resize, as `crop_to_aspect_ratio=True` does
+    img = tf.keras.preprocessing.image.smart_resize(img, img_size)
+    # Kept as uint8 until batched, a quarter of the size of float32 when cached
+    return tf.cast(tf.round(tf.clip_by_value(img, 0, 255)), tf.uint8)
+
+
+def record_paths(subset: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(records_dir, f"{subset}-*.tfrecord")))
+
+
+def records_fingerprint(paths: list[str], labels: list[int], img_size: tuple[int, int]) -> str:
+    'Identifies the images, their order and labels, and the size shards are written from'
+    digest = hashlib.blake2b(repr(tuple(img_size)).encode(), digest_size=16)
+    for path, label in zip(paths, labels):
+        digest.update(f"{path}\t{label}\n".encode())
+    return digest.hexdigest()
+
+
+def metadata_path(subset: str) -> str:
+    return os.path.join(records_dir, f"{subset}.json")
+
+
+def current_record_paths(paths: list[str], labels: list[int], img_size: tuple[int, int], subset: str) -> list[str]:
+    """The subset's TFRecord shards if they were written from these images and labels
+    at this size, otherwise none, as shards of another dataset, split or size would
+    train on the wrong images or fail to be reshaped."""
+    try:
+        with open(metadata_path(subset)) as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return []
+    if metadata['fingerprint'] != records_fingerprint(paths, labels, img_size):
+        return []
+    return record_paths(subset)
+
+
+def write_records(paths: list[str], labels: list[int], img_size: tuple[int, int], subset: str, num_shards: int):
+    'Decode and resize images on parallel calls and write them to TFRecord shards as raw pixels'
+    os.makedirs(records_dir, exist_ok=True)
+    # Removed first, so shards left incomplete by an interrupted write are never read
+    if os.path.exists(metadata_path(subset)):
+        os.remove(metadata_path(subset))
+    for path in record_paths(subset):
+        os.remove(path)
+    dataset = tf.data.Dataset.from_tensor_slices((paths, labels)).map(
+        lambda path, label: (decode_image(path, img_size), label), num_parallel_calls=AUTOTUNE)
+    writers = [tf.io.TFRecordWriter(os.path.join(records_dir, f"{subset}-{i:05d}-of-{num_shards:05d}.tfrecord"))
+               for i in range(num_shards)]
+    for i, (img, label) in enumerate(dataset.as_numpy_iterator()):
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[img.tobytes()])),
+            'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+        }))
+        writers[i % num_shards].write(example.SerializeToString())
+    for writer in writers:
+        writer.close()
+    with open(metadata_path(subset), 'w') as f:
+        json.dump({'fingerprint': records_fingerprint(paths, labels, img_size),
+                   'images': len(paths), 'img_size': list(img_size)}, f)
+
+
+def augment_image(img: tf.Tensor, label: tf.Tensor):
+    'Random horizontal flip and brightness change, different every epoch'
+    img = tf.image.random_flip_left_right(img)
+    img = tf.image.random_brightness(img, max_delta=0.1)
+    return img, label
+
+
+def make_dataset(paths: list[str],
+                 labels: list[int],
+                 img_shape: tuple[int, int, int],
+                 num_classes: int,
+                 batch_size: int,
+                 training: bool,
+                 records: list[str] = None,
+                 cache: bool = False,
+                 augment: bool = False,
+                 seed: int = None) -> tf.data.Dataset:
+    """Batches of float32 images and one-hot labels, read from TFRecord shards
+    if `records` are given, otherwise decoded from the image files.
+
+    Training batches are shuffled, and augmented if `augment`. With `cache`,
+    images are decoded once and held in memory for the following epochs,
+    about 75 KB per image.
+    """
+    if records:
+        files = tf.data.Dataset.from_tensor_slices(records)
+        if training:
+            files = files.shuffle(len(records), seed=seed)
+        dataset = files.interleave(tf.data.TFRecordDataset, num_parallel_calls=AUTOTUNE, deterministic=not training)
+
+        def parse(record):
+            example = tf.io.parse_single_example(record, record_features)
+            img = tf.reshape(tf.io.decode_raw(example['image'], tf.uint8), img_shape)
+            return img, example['label']
+        dataset = dataset.map(parse, num_parallel_calls=AUTOTUNE, deterministic=not training)
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+        if training and not cache:
+            # Shuffling paths is cheap, so every image can be shuffled with every other
+            dataset = dataset.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.map(lambda path, label: (decode_image(path, img_shape[:-1]), label),
+                              num_parallel_calls=AUTOTUNE, deterministic=not training)
+
+    if cache:
+        dataset = dataset.cache()
+    if training and (records or cache):
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    if training and augment:
+        dataset = dataset.map(augment_image, num_parallel_calls=AUTOTUNE, deterministic=False)
+
+    dataset = dataset.batch(batch_size, num_parallel_calls=AUTOTUNE).map(
+        lambda imgs, labels: (tf.cast(imgs, tf.float32), tf.one_hot(labels, num_classes)),
+        num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(AUTOTUNE)
@@ -0,0 +1,105 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+import sys
+import time
+import random
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from api.classify import MODEL_PATHS, ImageSceneClassifier
+
+# Converts the scene classifier to a quantized TFLite model for serving
+# with `ImageSceneClassifier(backend='tflite')`, and reports how often
+# its predictions agree with the float model.
+#
+# dynamic: weights are stored as int8, activations stay float
+# int8: weights and activations are int8, calibrated on training images
+
+training_dir = "./dataset/training/"
+num_calibration_imgs = 300
+num_eval_imgs = 1000
+seed = 889
+
+
+def load_images(paths: list[str]) -> np.ndarray:
+    images = [np.array(Image.open(path).convert("RGB")) for path in paths]
+    # Resized exactly as the server does
+    return ImageSceneClassifier.process_batch(images)
+
+
+def sample_paths(num_imgs: int, rng: random.Random, excluded: frozenset[str] = frozenset()) -> list[str]:
+    paths = [
+        path
+        for category in sorted(os.listdir(training_dir))
+        for filename in sorted(os.listdir(os.path.join(training_dir, category)))
+        if (path := os.path.join(training_dir, category, filename)) not in excluded
+    ]
+    return rng.sample(paths, min(num_imgs, len(paths)))
+
+
+def main():
+    try:
+        mode = sys.argv[1]
+        assert mode in ("dynamic", "int8")
+    except (IndexError, AssertionError):
+        print("Usage: 'py quantize.py <dynamic|int8>'")
+        return
+
+    rng = random.Random(seed)
+    model = tf.keras.models.load_model(MODEL_PATHS['keras'])
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    calibration_paths = []
+    if mode == "int8":
+        calibration_paths = sample_paths(num_calibration_imgs, rng)
+        calibration_imgs = load_images(calibration_paths)
+        # Activation ranges are calibrated one image at a time
+        converter.representative_dataset = lambda: ([img[np.newaxis]] for img in calibration_imgs)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        # Keep float input and output so both backends are fed the same batches
+
+    print(f"Converting with {mode} quantization...", end=" ")
+    tflite_model = converter.convert()
+    with open(MODEL_PATHS['tflite'], "wb") as f:
+        f.write(tflite_model)
+    print(f"done! Wrote {MODEL_PATHS['tflite']} ({len(tflite_model) / 2**20:.1f} MB)")
+
+    # Compare the quantized model against the float model on images it was not calibrated on
+    eval_imgs = load_images(sample_paths(num_eval_imgs, rng, excluded=frozenset(calibration_paths)))
+    float_classifier = ImageSceneClassifier(backend="keras")
+    tflite_classifier = ImageSceneClassifier(backend="tflite")
+    # Trace the float model for each bucket and allocate the interpreter's tensors before timing
+    float_classifier.predict_batch(eval_imgs)
+    tflite_classifier.predict_batch(eval_imgs)
+
+    start = time.perf_counter()
+    float_preds = float_classifier.predict_batch(eval_imgs)
+    float_time = time.perf_counter() - start
+    start = time.perf_counter()
+    tflite_preds = tflite_classifier.predict_batch(eval_imgs)
+    tflite_time = time.perf_counter() - start
+
+    float_top2 = np.argsort(float_preds, axis=1)[:, ::-1][:, :2]
+    tflite_top2 = np.argsort(tflite_preds, axis=1)[:, ::-1][:, :2]
+    top1_agreement = np.mean(float_top2[:, 0] == tflite_top2[:, 0])
+    # Same two categories, in either order
+    top2_agreement = np.all(np.sort(float_top2, axis=1) == np.sort(tflite_top2, axis=1), axis=1).mean()
+    tag_agreement = np.mean([
+        a == b for a, b in zip(float_classifier.tags_from_predictions(float_preds),
+                               tflite_classifier.tags_from_predictions(tflite_preds))
+    ])
+
+    print(f"Evaluated on {len(eval_imgs)} images")
+    print(f"Top-1 agreement: {top1_agreement:.3f}")
+    print(f"Top-2 agreement: {top2_agreement:.3f}")
+    print(f"Tag agreement:   {tag_agreement:.3f}")
+    print(f"Float: {1000 * float_time / len(eval_imgs):.2f} ms/image, "
+          f"TFLite: {1000 * tflite_time / len(eval_imgs):.2f} ms/image")
+
+
+if __name__ == '__main__':
+    main()
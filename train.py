@@ -1,7 +1,22 @@
+import sys
+import time
+
+import numpy as np
 import tensorflow as tf
 keras = tf.keras
 
 from model import build_transfer_model
+from pipeline import current_record_paths, make_dataset, split_images, write_records
+
+# train: fit a new model
+# preprocess: decode and resize every image once into TFRecord shards
+# benchmark: compare the time to read an epoch with each input pipeline
+#   against the model's own compute time
+#
+# --records trains on the TFRecord shards, which must have been written
+#   from the current dataset, split and image size
+# --cache holds decoded images in memory after the first epoch
+# --augment randomly flips and brightens training images
 
 training_dir = "./dataset/training/"
 models_dir = "./models/"
@@ -13,45 +28,152 @@ img_shape = (160, 160, 3)
 batch_size = 128
 num_classes = 36
 seed = 889
+num_shards = 16
+# Batches read or trained on by benchmark, to estimate the time of an epoch
+benchmark_batches = 20
+
+usage = "Usage: 'py train.py [preprocess|benchmark] [--records] [--cache] [--augment]'"
+
+
+class EpochTimer(keras.callbacks.Callback):
+    'Records how long each epoch takes'
+    def __init__(self):
+        super().__init__()
+        self.times = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.times.append(time.perf_counter() - self.start)
+
+
+def subset_records(subsets: dict, subset: str) -> list[str]:
+    return current_record_paths(*subsets[subset], img_shape[:-1], subset)
+
+
+def datasets(subsets: dict, cache: bool, augment: bool, use_records: bool):
+    return [
+        make_dataset(*subsets[subset], img_shape, num_classes, batch_size,
+                     training=subset == 'training', records=subset_records(subsets, subset) if use_records else None,
+                     cache=cache, augment=augment, seed=seed)
+        for subset in ('training', 'validation')
+    ]
+
+
+def train(subsets: dict, records: bool, cache: bool, augment: bool):
+    if records and not all(subset_records(subsets, subset) for subset in subsets):
+        print("The TFRecord shards are missing or were written from another dataset, split or image size. "
+              "Run 'py train.py preprocess' first")
+        return
+    print(f"Reading {'TFRecord shards' if records else 'image files'}"
+          f"{', cached in memory' if cache else ''}{', augmented' if augment else ''}")
+    train_ds, validation_ds = datasets(subsets, cache, augment, records)
+
+    model = build_transfer_model(img_shape, num_classes)
+    model.summary()
+
+    timer = EpochTimer()
+    history: tf.keras.callbacks.History = model.fit(
+        train_ds,
+        validation_data=validation_ds,
+        epochs=epochs,
+        callbacks=[timer]
+    )
+
+    final_loss = history.history['loss'][-1]
+    final_acc = history.history['val_categorical_accuracy'][-1]
+
+    model.save(f"{models_dir}loss__{final_loss:.2f}__acc__{final_acc:.2f}")
+
+    # The first epoch also fills the cache and traces the model
+    print(f"First epoch: {timer.times[0]:.1f}s")
+    if len(timer.times) > 1:
+        print(f"Later epochs: {np.mean(timer.times[1:]):.1f}s on average")
+
+
+def preprocess(subsets: dict):
+    for subset, (paths, labels) in subsets.items():
+        start = time.perf_counter()
+        print(f"Writing {len(paths)} {subset} images...", end=" ", flush=True)
+        write_records(paths, labels, img_shape[:-1], subset, num_shards)
+        print(f"done in {time.perf_counter() - start:.1f}s")
+
+
+def read_time(dataset: tf.data.Dataset) -> float:
+    'Seconds to read `benchmark_batches` batches'
+    start = time.perf_counter()
+    for _ in dataset.take(benchmark_batches):
+        pass
+    return time.perf_counter() - start
+
+
+def benchmark(subsets: dict):
+    num_batches = -(-len(subsets['training'][0]) // batch_size)
+    scale = num_batches / benchmark_batches
+    # As training read images before this pipeline: serially, with no cache or prefetch
+    legacy_ds = keras.utils.image_dataset_from_directory(
+        training_dir,
+        batch_size=batch_size,
+        image_size=img_shape[:-1],
+        subset="training",
+        validation_split=validation_split,
+        seed=seed,
+        label_mode='categorical',
+        crop_to_aspect_ratio=True
+    )
+    results = {'image_dataset_from_directory': read_time(legacy_ds) * scale}
+    results['parallel decode'] = read_time(datasets(subsets, False, False, False)[0]) * scale
+    cached_ds = datasets(subsets, True, False, False)[0]
+    # Fill the cache, which is only used once a whole epoch has been read
+    for _ in cached_ds:
+        pass
+    results['parallel decode, cached'] = read_time(cached_ds) * scale
+    if subset_records(subsets, 'training'):
+        results['TFRecord shards'] = read_time(datasets(subsets, False, False, True)[0]) * scale
+
+    model = build_transfer_model(img_shape, num_classes)
+    imgs = tf.random.uniform((batch_size, *img_shape), 0, 255)
+    labels = tf.one_hot(tf.random.uniform((batch_size,), 0, num_classes, dtype=tf.int32), num_classes)
+    model.train_on_batch(imgs, labels)  # Trace the training step
+    start = time.perf_counter()
+    for _ in range(benchmark_batches):
+        model.train_on_batch(imgs, labels)
+    model_time = (time.perf_counter() - start) * scale
+
+    print(f"\nEstimated seconds per epoch of {num_batches} batches, from {benchmark_batches} batches")
+    print(f"{'Model compute alone':<32} {model_time:>8.1f}")
+    legacy_time = results['image_dataset_from_directory']
+    for name, input_time in results.items():
+        print(f"{'Input: ' + name:<32} {input_time:>8.1f}  {legacy_time / input_time:>5.1f}x faster")
+    if 'TFRecord shards' not in results:
+        print("Run 'py train.py preprocess' to also benchmark TFRecord shards of the current dataset")
+
+
+def main():
+    args = sys.argv[1:]
+    mode = 'train'
+    if len(args) > 0 and not args[0].startswith('--'):
+        mode = args.pop(0)
+    flags = set(args)
+    if mode not in ('train', 'preprocess', 'benchmark') or not flags <= {'--records', '--cache', '--augment'}:
+        print(usage)
+        return
+
+    _, subsets = split_images(training_dir, validation_split, seed)
+    if mode == 'preprocess':
+        preprocess(subsets)
+    elif mode == 'benchmark':
+        benchmark(subsets)
+    else:
+        train(subsets, records='--records' in flags, cache='--cache' in flags, augment='--augment' in flags)
+
+
+if __name__ == '__main__':
+    main()
 
-train_ds = keras.utils.image_dataset_from_directory(
-    training_dir,
-    batch_size=batch_size,
-    image_size=img_shape[:-1],
-    subset="training",
-    validation_split=validation_split,
-    seed=seed,
-    label_mode='categorical',
-    crop_to_aspect_ratio=True
-)
-
-validation_ds = keras.utils.image_dataset_from_directory(
-    training_dir,
-    batch_size=batch_size,
-    image_size=img_shape[:-1],
-    subset="validation",
-    validation_split=validation_split,
-    seed=seed,
-    label_mode='categorical',
-    crop_to_aspect_ratio=True
-)
-
-
-model = build_transfer_model(img_shape, num_classes)
-model.summary()
-
-history: tf.keras.callbacks.History = model.fit(
-    train_ds,
-    validation_data=validation_ds,
-    epochs=epochs
-)
-
-final_loss = history.history['loss'][-1]
-final_acc = history.history['val_categorical_accuracy'][-1]
-
-model.save(f"{models_dir}loss__{final_loss:.2f}__acc__{final_acc:.2f}")
 
 # A note on model accuracy
 # Some classes are purposefully chosen to overlap with others as
 # it is intended to select the "Top 3" predictions from the softmax
-# distribution
\ No newline at end of file
+# distribution